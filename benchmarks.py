@@ -0,0 +1,663 @@
+"""
+Performance checks against a local stub server, e.g.
+
+    python3 benchmarks.py fetch --cities 2000
+    python3 benchmarks.py suite --cities 5000 --output bench-results/current.json
+    python3 benchmarks.py compare bench-results/base.json bench-results/current.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from external.analyzer import DayInfo, analyze_batch, analyze_json, dump_data, find_input_files, load_data
+from external.cache import ResponseCache
+from external.forecast_store import ForecastStore, ForecastStoreBuilder
+from external.stream_parser import loads_forecasts, project_day
+from fetch_policy import FetchPolicy
+from incremental import IncrementalCalculation
+from log_progress import setup_logging
+from pipeline import WeatherPipeline
+from ranking import RankingIndex
+from stub_server import StubWeatherServer, load_example_response, make_cities_payloads, make_city_payload
+from tasks import (
+    DataAggregationTask,
+    DataAnalyzingTask,
+    DataCalculationTask,
+    DataFetchingTask,
+    shutdown_process_pool,
+)
+from writers import WRITERS, write_results
+
+
+def bench_fetch(args):
+    payloads = make_cities_payloads(args.cities)
+    with StubWeatherServer(payloads) as server:
+        cities = server.cities()
+
+        threads_task = DataFetchingTask(workers=args.workers)
+        started = time.perf_counter()
+        threads_task.get_cities_weather(cities=cities)
+        threads_time = time.perf_counter() - started
+
+        async_task = DataFetchingTask(concurrency=args.concurrency)
+        started = time.perf_counter()
+        async_task.get_cities_weather_async(cities=cities)
+        async_time = time.perf_counter() - started
+
+    print(f"cities: {args.cities}")
+    print(
+        f"threads (workers={args.workers}): {threads_time:.2f}s, "
+        f"{len(threads_task.weather_info) / threads_time:.0f} cities/s"
+    )
+    print(
+        f"async (concurrency={args.concurrency}): {async_time:.2f}s, "
+        f"{len(async_task.weather_info) / async_time:.0f} cities/s"
+    )
+
+
+def bench_cache(args):
+    payloads = make_cities_payloads(args.cities)
+    with StubWeatherServer(payloads) as server, tempfile.TemporaryDirectory() as tmp:
+        cities = server.cities()
+        cache = ResponseCache(path=os.path.join(tmp, "responses.sqlite3"), ttl=3600)
+        for run in ("cold", "warm", "revalidated"):
+            if run == "revalidated":
+                cache.ttl = 0
+            server.requests.clear()
+            task = DataFetchingTask(workers=args.workers, cache=cache)
+            started = time.perf_counter()
+            task.get_cities_weather(cities=cities)
+            elapsed = time.perf_counter() - started
+            print(f"{run}: {elapsed:.2f}s, server responses: {dict(server.requests)}")
+        print(f"cache stats: {cache.stats()}")
+
+
+def bench_parse(args):
+    payloads = list(make_cities_payloads(args.cities).values())
+    print(f"cities: {args.cities}, payload: {sum(map(len, payloads)) / 2 ** 20:.1f} MiB")
+    for name, parse in (("json.loads", json.loads), ("streaming", loads_forecasts)):
+        started = time.perf_counter()
+        for body in payloads:
+            parse(body)
+        elapsed = time.perf_counter() - started
+
+        tracemalloc.start()
+        parse(payloads[0])
+        _, single_peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        kept = [parse(body) for body in payloads]
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del kept
+
+        print(
+            f"{name}: {elapsed:.2f}s, peak per response {single_peak / 2 ** 10:.0f} KiB, "
+            f"all cities kept {retained / 2 ** 20:.1f} MiB (peak {peak / 2 ** 20:.1f} MiB)"
+        )
+
+
+def make_cities_info(n_cities: int) -> dict:
+    """Decoded forecasts for `n_cities`, reduced to the fields used by the calculation"""
+    example = load_example_response()
+    base = {"forecasts": [project_day(day) for day in example["forecasts"]]}
+    return {f"CITY{i:06d}": make_city_payload(base, seed=i) for i in range(n_cities)}
+
+
+def bench_calc(args):
+    info = make_cities_info(args.cities)
+    cities = list(info)
+    print(f"cities: {args.cities}")
+
+    task = DataCalculationTask(info=info)
+    started = time.perf_counter()
+    expected = {}
+    for city in cities:
+        expected.update(task.calc_weather_stats(city))
+    print(f"per-city loop: {time.perf_counter() - started:.2f}s")
+
+    engines = ["vectorized"]
+    if args.cities <= args.process_limit:
+        engines.insert(0, "process")
+    for engine in engines:
+        task = DataCalculationTask(info=info)
+        started = time.perf_counter()
+        task.run_concurrent(cities=cities, engine=engine)
+        elapsed = time.perf_counter() - started
+        same = "identical" if task.weather_analytics == expected else "DIFFERENT"
+        print(f"run_concurrent(engine={engine!r}): {elapsed:.2f}s, result {same}")
+
+    # the columns of a ForecastStore are used as they are, dict input is taken apart hour by hour
+    builder = ForecastStoreBuilder()
+    for city, city_data in info.items():
+        builder.add(city, city_data)
+    task = DataCalculationTask(info=builder.build())
+    started = time.perf_counter()
+    task.run_concurrent(cities=cities, engine="vectorized")
+    elapsed = time.perf_counter() - started
+    same = "identical" if task.weather_analytics == expected else "DIFFERENT"
+    print(f"run_concurrent(engine='vectorized') over a ForecastStore: {elapsed:.2f}s, result {same}")
+
+
+def bench_pool(args):
+    for n_cities in args.cities:
+        info = make_cities_info(n_cities)
+        cities = list(info)
+        timings = []
+        for engine in ("process", "pool", "pool"):
+            if engine == "process" and n_cities > args.process_limit:
+                timings.append("skipped")
+                continue
+            task = DataCalculationTask(info=info)
+            started = time.perf_counter()
+            task.run_concurrent(cities=cities, engine=engine)
+            timings.append(f"{time.perf_counter() - started:.2f}s")
+        print(f"cities {n_cities}: process {timings[0]}, pool first run {timings[1]}, pool next run {timings[2]}")
+
+
+def bench_pipeline(args):
+    payloads = make_cities_payloads(args.cities)
+    slow_city = next(iter(payloads))
+    with StubWeatherServer(payloads, delays={slow_city: args.slow_delay}) as server:
+        cities = server.cities()
+
+        started = time.perf_counter()
+        fetching_task = DataFetchingTask(workers=args.workers)
+        fetching_task.get_cities_weather(cities=cities)
+        calculation_task = DataCalculationTask(info=fetching_task.weather_info)
+        calculation_task.run_concurrent(cities=list(cities), engine="pool")
+        staged_df = DataAggregationTask(data=calculation_task.weather_analytics).merge_results()
+        staged_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        weather_pipeline = WeatherPipeline(workers=args.workers)
+        pipeline_df = weather_pipeline.run(cities=cities)
+        pipeline_time = time.perf_counter() - started
+
+    same = "identical" if pipeline_df.equals(staged_df) else "DIFFERENT"
+    print(f"cities: {args.cities}, one city delayed by {args.slow_delay}s")
+    print(f"staged: {staged_time:.2f}s end-to-end")
+    print(
+        f"pipeline: {pipeline_time:.2f}s end-to-end, first city aggregated after "
+        f"{weather_pipeline.first_result_latency:.2f}s, DataFrame {same}"
+    )
+
+
+def bench_incremental(args):
+    info = make_cities_info(args.cities)
+    with tempfile.TemporaryDirectory() as tmp:
+        state_path = os.path.join(tmp, "state.json")
+        for run in ("first", "rerun"):
+            if run == "rerun":
+                for city in list(info)[:int(args.cities * args.changed)]:
+                    info[city]["forecasts"][0]["hours"][12]["temp"] += 1
+            incremental = IncrementalCalculation(state_path=state_path)
+            started = time.perf_counter()
+            incremental.run(info)
+            elapsed = time.perf_counter() - started
+            print(f"{run}: {elapsed:.2f}s, recomputed {incremental.recomputed}, skipped {incremental.skipped}")
+
+    started = time.perf_counter()
+    calculation_task = DataCalculationTask(info=info)
+    calculation_task.run_concurrent(cities=list(info), engine="pool")
+    DataAggregationTask(data=calculation_task.weather_analytics).merge_results()
+    print(f"full run: {time.perf_counter() - started:.2f}s")
+
+
+def make_results_frame(n_cities: int) -> pd.DataFrame:
+    """Per-city table shaped like DataAggregationTask.merge_results output"""
+    rnd = np.random.default_rng(n_cities)
+    daily = pd.DataFrame({
+        "city": [f"CITY{i:06d}" for i in range(n_cities)],
+        "date": "2022-05-18",
+        "avg_temp": rnd.normal(15, 10, n_cities),
+        "n_hours_good_weather": rnd.integers(0, 12, n_cities),
+    })
+    return DataAggregationTask.rank_cities(daily)
+
+
+def bench_writers(args):
+    formats = args.formats or [fmt for fmt in WRITERS if fmt != "xlsx"]
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_cities in args.cities:
+            df = make_results_frame(n_cities)
+            for fmt in formats:
+                path = os.path.join(tmp, f"weather-stats.{fmt}")
+                started = time.perf_counter()
+                write_results(df, path)
+                elapsed = time.perf_counter() - started
+                print(f"cities {n_cities}, {fmt}: {elapsed:.3f}s, {os.path.getsize(path) / 2 ** 10:.0f} KiB")
+
+
+def import_time_us(module: str) -> int:
+    """Cumulative import time of `module` from -X importtime"""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True, check=True
+    ).stderr
+    # "import time:  self [us] | cumulative | imported package", the module itself is the last line
+    for line in reversed(stderr.splitlines()):
+        _, cumulative_us, name = line.split("|")
+        if name.strip() == module:
+            return int(cumulative_us)
+    raise ValueError(f"No import time for {module}")
+
+
+def best_wall_time(command: list, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run(command, check=True, capture_output=True)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def bench_startup(args):
+    for module in ("tasks", "forecasting", "quick_forecast"):
+        print(f"{'-X importtime ' + module:<30} {import_time_us(module) / 1e3:8.1f} ms")
+
+    with StubWeatherServer(make_cities_payloads(args.cities)) as server, tempfile.TemporaryDirectory() as tmp:
+        cities_file = os.path.join(tmp, "cities.json")
+        with open(cities_file, "w") as file:
+            json.dump(server.cities(), file)
+        commands = {
+            "forecast_weather": [
+                sys.executable, "-c",
+                "import json, forecasting; forecasting.forecast_weather("
+                f"cities=json.load(open({cities_file!r})), calc_engine='vectorized',"
+                f" results_path={os.path.join(tmp, 'weather-stats.csv')!r})",
+            ],
+            "quick_forecast": [
+                sys.executable, "-m", "quick_forecast", "--cities-file", cities_file,
+                "--output", os.path.join(tmp, "weather-stats.csv"),
+            ],
+        }
+        for name, command in commands.items():
+            label = f"{name} ({args.cities} cities)"
+            print(f"{label:<30} {best_wall_time(command, args.repeat) * 1e3:8.1f} ms")
+
+
+def bench_faults(args):
+    payloads = make_cities_payloads(args.cities)
+    policies = {
+        "no retries": FetchPolicy(retries=0),
+        "timeout + retries": FetchPolicy(timeout=args.timeout, retries=2, backoff=0.05),
+        "timeout + retries + hedging": FetchPolicy(timeout=args.timeout, retries=2, backoff=0.05, hedge=True),
+    }
+    for name, policy in policies.items():
+        with StubWeatherServer(
+            payloads, failure_rate=args.failure_rate, slow_rate=args.slow_rate, slow_delay=args.slow_delay, seed=0
+        ) as server:
+            task = DataFetchingTask(workers=args.workers, policy=policy)
+            started = time.perf_counter()
+            task.get_cities_weather(cities=server.cities())
+            elapsed = time.perf_counter() - started
+        city_latency = sorted(report["elapsed_s"] for report in task.fetch_report.values())
+        p99 = city_latency[int(len(city_latency) * 0.99)]
+        lost = args.cities - len(task.weather_info)
+        print(f"{name:<28} {elapsed:6.2f}s, p99 per city {p99:.3f}s, cities lost {lost}, {task.metrics.counters}")
+
+
+def bench_ranking(args):
+    df = make_results_frame(args.cities)
+    started = time.perf_counter()
+    index = RankingIndex(df)
+    print(f"build: {time.perf_counter() - started:.3f}s")
+
+    started = time.perf_counter()
+    DataAnalyzingTask(df=df).analyze_cities()
+    print(f"analyze_cities:                 {(time.perf_counter() - started) * 1e3:8.3f} ms")
+    started = time.perf_counter()
+    index.best_cities()
+    print(f"RankingIndex.best_cities:       {(time.perf_counter() - started) * 1e3:8.3f} ms")
+
+    weights = {"avg_temp": 0.7, "n_hours_good_weather": 1.5}
+    started = time.perf_counter()
+    (df.avg_temp * weights["avg_temp"] + df.n_hours_good_weather * weights["n_hours_good_weather"]).nlargest(args.k)
+    print(f"pandas weighted nlargest:       {(time.perf_counter() - started) * 1e3:8.3f} ms")
+    started = time.perf_counter()
+    index.top_k(args.k, weights=weights)
+    print(f"RankingIndex.top_k weighted:    {(time.perf_counter() - started) * 1e3:8.3f} ms")
+    started = time.perf_counter()
+    index.top_k(args.k, by="cumulative_rank")
+    print(f"RankingIndex.top_k by rank:     {(time.perf_counter() - started) * 1e3:8.3f} ms")
+
+
+def analyze_json_dataclasses(data: dict) -> dict:
+    """analyze_json as it was before the batch mode: a DayInfo and HourInfo per day and hour"""
+    return {"days": [DayInfo(raw_data=day_data).to_json() for day_data in data["forecasts"]]}
+
+
+def bench_analyzer(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        input_dir = os.path.join(tmp, "responses")
+        os.makedirs(input_dir)
+        for city, body in make_cities_payloads(args.files).items():
+            with open(os.path.join(input_dir, f"{city}.json"), "wb") as file:
+                file.write(body)
+        input_paths = find_input_files(input_dir)
+        output_path = os.path.join(tmp, "output.json")
+
+        # the CLI once per file, as it had to be run over an archive so far
+        sample = input_paths[:args.cli_sample]
+        started = time.perf_counter()
+        for path in sample:
+            subprocess.run(
+                [sys.executable, "external/analyzer.py", "-i", path, "-o", output_path], check=True
+            )
+        elapsed = time.perf_counter() - started
+        print(f"CLI per file ({len(sample)} files): {len(sample) / elapsed:8.0f} files/s")
+
+        for name, analyze in (("dataclasses", analyze_json_dataclasses), ("records", analyze_json)):
+            started = time.perf_counter()
+            for path in input_paths:
+                dump_data(analyze(load_data(path)), output_path)
+            elapsed = time.perf_counter() - started
+            print(f"in-process loop, {name:<11}: {len(input_paths) / elapsed:8.0f} files/s")
+
+        for workers in args.workers:
+            started = time.perf_counter()
+            analyze_batch(input_paths, output_path, workers=workers)
+            elapsed = time.perf_counter() - started
+            print(f"batch, {workers} workers: {len(input_paths) / elapsed:8.0f} files/s")
+
+
+def peak_rss_mib() -> dict:
+    """
+    High-water marks of this process and of the largest finished child (the pool workers count when they exit).
+    RUSAGE_CHILDREN holds the peak of a single child, not the sum of the workers
+    """
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    scale = 2 ** 20 if sys.platform == "darwin" else 2 ** 10
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+        "largest_child": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale,
+    }
+
+
+def store_memory_run(variant: str, n_cities: int, engine: str, store_path: str) -> dict:
+    """
+    One variant of bench_store, in a fresh process so that the peak RSS is its own:
+        "json" - decoded payloads of all cities kept as in DataFetchingTask.weather_info,
+        "store" - every payload encoded into a ForecastStore as it arrives, saved to `store_path`,
+        "mmap" - the ForecastStore of `store_path` mapped by this process and the pool workers
+    """
+    started = time.perf_counter()
+    if variant == "mmap":
+        info = ForecastStore.open(store_path)
+    else:
+        base = load_example_response()
+        builder = ForecastStoreBuilder()
+        info = {}
+        for i in range(n_cities):
+            city_data = make_city_payload(base, seed=i)
+            if variant == "json":
+                info[f"CITY{i:06d}"] = city_data
+            else:
+                builder.add(f"CITY{i:06d}", city_data)
+        if variant == "store":
+            info = builder.build()
+            info.save(store_path)
+    load_time = time.perf_counter() - started
+
+    task = DataCalculationTask(info=info)
+    started = time.perf_counter()
+    task.run_concurrent(cities=[f"CITY{i:06d}" for i in range(n_cities)], engine=engine)
+    calc_time = time.perf_counter() - started
+    # the pool workers count in RUSAGE_CHILDREN once they exit
+    shutdown_process_pool()
+    analytics = json.dumps(task.weather_analytics, sort_keys=True).encode("utf-8")
+    return {
+        "load_s": load_time,
+        "calc_s": calc_time,
+        "store_bytes": info.nbytes if isinstance(info, ForecastStore) else None,
+        "analytics": hashlib.blake2b(analytics, digest_size=16).hexdigest(),
+        "peak_rss_mib": peak_rss_mib(),
+    }
+
+
+def bench_store(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        store_path = os.path.join(tmp, "forecasts.fcst")
+        for n_cities in args.cities:
+            results = {}
+            for variant in ("json", "store", "mmap"):
+                command = [
+                    sys.executable, "-c",
+                    "import benchmarks, json; print(json.dumps(benchmarks.store_memory_run("
+                    f"{variant!r}, {n_cities}, {args.calc_engine!r}, {store_path!r})))",
+                ]
+                stdout = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+                results[variant] = result = json.loads(stdout.splitlines()[-1])
+                same = "identical" if result["analytics"] == results["json"]["analytics"] else "DIFFERENT"
+                store_size = f", store {result['store_bytes'] / 2 ** 20:.1f} MiB" if result["store_bytes"] else ""
+                print(
+                    f"cities {n_cities}, {variant:<5}: load {result['load_s']:6.2f}s, "
+                    f"calc[{args.calc_engine}] {result['calc_s']:6.2f}s, "
+                    f"peak RSS {result['peak_rss_mib']['self']:6.0f} MiB "
+                    f"(largest worker {result['peak_rss_mib']['largest_child']:4.0f} MiB){store_size}, result {same}"
+                )
+
+
+class StageTimer:
+    """
+    Wall and cpu time of every stage. ru_maxrss is a high-water mark of the whole run, so the
+    "peak_rss_mib_cumulative" of a stage is the peak so far, not the memory of that stage alone
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def run(self, name: str, items: int, func, *args, **kwargs):
+        started, cpu_started = time.perf_counter(), time.process_time()
+        result = func(*args, **kwargs)
+        wall = time.perf_counter() - started
+        cpu = time.process_time() - cpu_started
+        # the shared pool workers count in RUSAGE_CHILDREN only once they exit, the next stage starts a new pool
+        shutdown_process_pool()
+        self.stages[name] = {
+            "wall_s": round(wall, 6),
+            "cpu_s": round(cpu, 6),
+            "items": items,
+            "items_per_s": round(items / wall, 2) if wall else None,
+            "peak_rss_mib_cumulative": peak_rss_mib(),
+        }
+        print(f"{name:<32} {wall:8.3f}s {self.stages[name]['items_per_s'] or 0:12.0f} items/s")
+        return result
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_suite(n_cities: int, workers: int, calc_engine: str, results_format: str) -> dict:
+    timer = StageTimer()
+    payloads = timer.run("generate_payloads", n_cities, make_cities_payloads, n_cities)
+    with StubWeatherServer(payloads) as server, tempfile.TemporaryDirectory() as tmp:
+        cities = server.cities()
+
+        fetching_task = DataFetchingTask(workers=workers)
+        timer.run("DataFetchingTask", n_cities, fetching_task.get_cities_weather, cities=cities)
+        info = fetching_task.weather_info
+
+        calculation_task = DataCalculationTask(info=info)
+        timer.run(
+            f"DataCalculationTask[{calc_engine}]", n_cities,
+            calculation_task.run_concurrent, cities=list(cities), engine=calc_engine,
+        )
+
+        aggregation_task = DataAggregationTask(data=calculation_task.weather_analytics)
+        timer.run("DataAggregationTask.merge_results", n_cities, aggregation_task.merge_results)
+        results_path = os.path.join(tmp, f"weather-stats.{results_format}")
+        timer.run(
+            f"DataAggregationTask.save_results[{results_format}]", n_cities,
+            aggregation_task.save_results, path=results_path,
+        )
+        results_size = os.path.getsize(results_path)
+
+        analyzing_task = DataAnalyzingTask(df=aggregation_task.df)
+        timer.run("DataAnalyzingTask", n_cities, analyzing_task.analyze_cities)
+
+        timer.run("analyzer.analyze_json", n_cities, lambda: [analyze_json(data) for data in info.values()])
+
+    return {
+        "revision": git_revision(),
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "params": {
+            "cities": n_cities,
+            "workers": workers,
+            "calc_engine": calc_engine,
+            "results_format": results_format,
+            "payload_bytes": sum(map(len, payloads.values())),
+            "results_bytes": results_size,
+        },
+        "stages": timer.stages,
+        "total_wall_s": round(sum(stage["wall_s"] for stage in timer.stages.values()), 6),
+        "peak_rss_mib_cumulative": peak_rss_mib(),
+    }
+
+
+def bench_suite(args):
+    report = run_suite(args.cities, args.workers, args.calc_engine, args.results_format)
+    rss = report["peak_rss_mib_cumulative"]
+    print(f"peak RSS of the run: {rss['self']:.0f} MiB (largest worker: {rss['largest_child']:.0f} MiB)")
+    if args.output:
+        directory = os.path.dirname(args.output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.output, "w") as file:
+            file.write(json.dumps(report, indent=2))
+        print(f"results: {args.output}")
+
+
+def bench_compare(args):
+    with open(args.base) as file:
+        base = json.load(file)
+    with open(args.current) as file:
+        current = json.load(file)
+    print(f"{'stage':<40} {base['revision']:>10} {current['revision']:>10} {'change':>8}")
+    for name, stage in current["stages"].items():
+        if name not in base["stages"]:
+            print(f"{name:<40} {'-':>10} {stage['wall_s']:>9.3f}s")
+            continue
+        before, after = base["stages"][name]["wall_s"], stage["wall_s"]
+        change = f"{(after - before) / before:+.0%}" if before else "-"
+        print(f"{name:<40} {before:>9.3f}s {after:>9.3f}s {change:>8}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    fetch = subparsers.add_parser("fetch", help="thread-queue vs asyncio fetching")
+    fetch.add_argument("--cities", type=int, default=2000)
+    fetch.add_argument("--workers", type=int, default=5)
+    fetch.add_argument("--concurrency", type=int, default=50)
+    fetch.set_defaults(func=bench_fetch)
+
+    cache = subparsers.add_parser("cache", help="cold, warm and revalidating runs with ResponseCache")
+    cache.add_argument("--cities", type=int, default=2000)
+    cache.add_argument("--workers", type=int, default=5)
+    cache.set_defaults(func=bench_cache)
+
+    parse = subparsers.add_parser("parse", help="full json.loads vs streaming projection")
+    parse.add_argument("--cities", type=int, default=1000)
+    parse.set_defaults(func=bench_parse)
+
+    calc = subparsers.add_parser("calc", help="DataCalculationTask engines")
+    calc.add_argument("--cities", type=int, default=10000)
+    calc.add_argument(
+        "--process-limit", type=int, default=1000,
+        help="skip the process engine above this number of cities, it pickles all cities for every city",
+    )
+    calc.set_defaults(func=bench_calc)
+
+    pool = subparsers.add_parser("pool", help="process per city vs persistent pool with chunks")
+    pool.add_argument("--cities", type=int, nargs="+", default=[100, 200, 400, 800, 10000])
+    pool.add_argument("--process-limit", type=int, default=800)
+    pool.set_defaults(func=bench_pool)
+
+    pipeline = subparsers.add_parser("pipeline", help="staged forecast flow vs WeatherPipeline")
+    pipeline.add_argument("--cities", type=int, default=2000)
+    pipeline.add_argument("--workers", type=int, default=5)
+    pipeline.add_argument("--slow-delay", type=float, default=2.0)
+    pipeline.set_defaults(func=bench_pipeline)
+
+    incremental = subparsers.add_parser("incremental", help="full vs incremental recomputation")
+    incremental.add_argument("--cities", type=int, default=10000)
+    incremental.add_argument("--changed", type=float, default=0.05, help="share of cities changed between runs")
+    incremental.set_defaults(func=bench_incremental)
+
+    writers = subparsers.add_parser("writers", help="write time and file size of result formats")
+    writers.add_argument("--cities", type=int, nargs="+", default=[1000, 10000, 100000])
+    writers.add_argument("--formats", nargs="+", choices=list(WRITERS), help="xlsx is opt-in, it needs openpyxl")
+    writers.set_defaults(func=bench_writers)
+
+    startup = subparsers.add_parser("startup", help="import time and short runs, pandas flow vs quick_forecast")
+    startup.add_argument("--cities", type=int, default=1)
+    startup.add_argument("--repeat", type=int, default=5)
+    startup.set_defaults(func=bench_startup)
+
+    faults = subparsers.add_parser("faults", help="fetch policies against slow and failing responses")
+    faults.add_argument("--cities", type=int, default=1000)
+    faults.add_argument("--workers", type=int, default=10)
+    faults.add_argument("--failure-rate", type=float, default=0.05)
+    faults.add_argument("--slow-rate", type=float, default=0.02)
+    faults.add_argument("--slow-delay", type=float, default=2.0)
+    faults.add_argument("--timeout", type=float, default=0.5, help="per attempt, for the policies with retries")
+    faults.set_defaults(func=bench_faults)
+
+    ranking = subparsers.add_parser("ranking", help="analyze_cities and pandas queries vs RankingIndex")
+    ranking.add_argument("--cities", type=int, default=100000)
+    ranking.add_argument("-k", type=int, default=10)
+    ranking.set_defaults(func=bench_ranking)
+
+    analyzer = subparsers.add_parser("analyzer", help="external/analyzer.py per file vs the batch mode")
+    analyzer.add_argument("--files", type=int, default=2000)
+    analyzer.add_argument("--cli-sample", type=int, default=50, help="files analyzed by running the CLI per file")
+    analyzer.add_argument("--workers", type=int, nargs="+", default=sorted({1, os.cpu_count() or 1}))
+    analyzer.set_defaults(func=bench_analyzer)
+
+    store = subparsers.add_parser("store", help="peak RSS of json payloads vs ForecastStore, in memory and mapped")
+    store.add_argument("--cities", type=int, nargs="+", default=[2000, 20000])
+    store.add_argument("--calc-engine", choices=("vectorized", "pool"), default="pool")
+    store.set_defaults(func=bench_store)
+
+    suite = subparsers.add_parser("suite", help="every pipeline stage on synthetic load")
+    suite.add_argument("--cities", type=int, default=2000)
+    suite.add_argument("--workers", type=int, default=5)
+    suite.add_argument("--calc-engine", choices=DataCalculationTask.ENGINES, default="pool")
+    suite.add_argument("--results-format", choices=list(WRITERS), default="csv")
+    suite.add_argument("--output", help="json file with the results, e.g. bench-results/<revision>.json")
+    suite.set_defaults(func=bench_suite)
+
+    compare = subparsers.add_parser("compare", help="per-stage wall time of two suite results")
+    compare.add_argument("base")
+    compare.add_argument("current")
+    compare.set_defaults(func=bench_compare)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    setup_logging()
+    args = parse_args()
+    args.func(args)
@@ -1,10 +1,13 @@
 import argparse
+import concurrent.futures
+import glob
 import json
 import logging
+import os
 from dataclasses import dataclass, field
-from functools import reduce
+from functools import lru_cache, reduce
 from operator import getitem
-from typing import Optional, List, Dict
+from typing import Any, Callable, Iterable, Iterator, NamedTuple, Optional, List, Dict, Tuple
 
 PATH_FROM_INPUT = "./../examples/response.json"
 PATH_TO_OUTPUT = "./../examples/output.json"
@@ -40,6 +43,9 @@ INPUT_DAY_SUITABLE_CONDITIONS = [
     # "thunderstorm-with-hail"
 ]
 
+# ForecastStore of external/forecast_store.py saved to a file
+STORE_SUFFIX = ".fcst"
+
 OUTPUT_RAW_DATA_KEY = "raw_data"
 OUTPUT_DAYS_KEY = "days"
 DEFAULT_OUTPUT_RESULT = {
@@ -48,13 +54,38 @@ DEFAULT_OUTPUT_RESULT = {
 }
 
 
+@lru_cache(maxsize=None)
+def split_path(path: str) -> tuple:
+    return tuple(path.split(">"))
+
+
 def deep_getitem(obj, path: str):
     try:
-        return reduce(getitem, path.split(">"), obj)
+        return reduce(getitem, split_path(path), obj)
     except (KeyError, TypeError):
         return None
 
 
+def compile_path(path: str) -> Callable[[Any], Any]:
+    """deep_getitem with the path split once"""
+    keys = split_path(path)
+
+    def getter(obj):
+        try:
+            for key in keys:
+                obj = obj[key]
+            return obj
+        except (KeyError, TypeError):
+            return None
+
+    return getter
+
+
+get_forecasts = compile_path(INPUT_FORECAST_PATH)
+get_temperature = compile_path(INPUT_TEMPERATURE_PATH)
+get_condition = compile_path(INPUT_CONDITION_PATH)
+
+
 def load_data(input_path: str = PATH_FROM_INPUT):
     with open(input_path) as file:
         data = file.read()
@@ -74,14 +105,22 @@ def parse_args():
         "--input",
         default=PATH_FROM_INPUT,
         type=str,
-        help="path to file with input data",
+        help="path to file with input data, a directory or a glob of them for the batch mode, "
+             f"or a forecast store ({STORE_SUFFIX}) of many cities",
     )
     parser.add_argument(
         "-o",
         "--output",
         default=PATH_TO_OUTPUT,
         type=str,
-        help="path to file with result",
+        help="path to file with result, one json line per city in the batch mode",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=None,
+        type=int,
+        help="worker processes of the batch mode, all CPUs by default",
     )
     parser.add_argument("-v", "--verbose", action="store_true")
     return parser.parse_args()
@@ -175,33 +214,205 @@ class DayInfo:
             self.temperature_avg = temp / hours_count
 
 
+# hour, temperature, condition: a plain tuple is several times cheaper to build than a NamedTuple
+HourRecord = Tuple[int, int, Optional[str]]
+
+
+class DayRecord(NamedTuple):
+    """Same values as DayInfo, without keeping the raw data and per-hour objects"""
+
+    date: Optional[str] = None
+    hour_start: Optional[int] = None
+    hour_end: Optional[int] = None
+    hours_count: Optional[int] = None
+    temperature_avg: Optional[float] = None
+    relevant_condition_hours: int = 0
+
+    to_json = DayInfo.to_json
+
+
+def parse_hours(hours_data: Iterable[dict]) -> Iterator[HourRecord]:
+    """Hours between INPUT_DAY_HOURS_START and INPUT_DAY_HOURS_END only"""
+    for hour_data in hours_data:
+        hour = int(hour_data[INPUT_HOUR_PATH])
+        if INPUT_DAY_HOURS_START <= hour <= INPUT_DAY_HOURS_END:
+            yield hour, int(get_temperature(hour_data)), get_condition(hour_data)
+
+
+def parse_day(day_data: dict) -> DayRecord:
+    if not day_data:
+        return DayRecord()
+    return day_record(day_data[INPUT_DATE_PATH], parse_hours(day_data[INPUT_HOURS_PATH]))
+
+
+def day_record(date: str, hours: Iterable[HourRecord]) -> DayRecord:
+    """Summary of the hours between INPUT_DAY_HOURS_START and INPUT_DAY_HOURS_END of one day"""
+    hour_start = hour_end = None
+    temp = 0
+    hours_count = 0
+    conds_count = 0
+    for hour, temperature, condition in hours:
+        hour_start = hour_start or hour
+        hour_end = hour
+        temp += temperature
+        if condition in INPUT_DAY_SUITABLE_CONDITIONS:
+            conds_count += 1
+        hours_count += 1
+
+    return DayRecord(
+        date=date,
+        hour_start=hour_start,
+        hour_end=hour_end,
+        hours_count=hours_count,
+        temperature_avg=temp / hours_count if hours_count > 0 else None,
+        relevant_condition_hours=conds_count,
+    )
+
+
 def analyze_json(data):
     if not data:
         logging.warning("Input data is empty...")
         return {}
 
     # analyzing days
-    time_start = None
-    time_end = None
-
-    days_data = deep_getitem(data, INPUT_FORECAST_PATH)
-    days = []
+    days_data = get_forecasts(data)
     # ToDo force sort by day in asc mode
-    for day_data in days_data:
-        d_info = DayInfo(raw_data=day_data)
-        d_date = d_info.date
+    days = [parse_day(day_data).to_json() for day_data in days_data]
 
-        time_start = time_start or d_date
-        time_end = d_date
+    # a new dict on every call, DEFAULT_OUTPUT_RESULT stays untouched
+    result = dict(DEFAULT_OUTPUT_RESULT)
+    # result[OUTPUT_RAW_DATA_KEY] = data
+    result[OUTPUT_DAYS_KEY] = days
+    return result
 
-        days.append(d_info.to_json())
 
-    result = DEFAULT_OUTPUT_RESULT
-    # result[OUTPUT_RAW_DATA_KEY] = data
+def find_input_files(input_path: str) -> List[str]:
+    """Json files of a directory or the files matching a glob pattern"""
+    if os.path.isdir(input_path):
+        input_path = os.path.join(input_path, "*.json")
+    return sorted(glob.glob(input_path))
+
+
+def is_batch_input(input_path: str) -> bool:
+    return os.path.isdir(input_path) or glob.has_magic(input_path)
+
+
+def analyze_files(input_paths: List[str]) -> List[str]:
+    """
+    Runs in a worker process.
+    Returns one NDJSON line per file, the city is the name of the file without extension.
+    """
+    lines = []
+    for input_path in input_paths:
+        city = os.path.splitext(os.path.basename(input_path))[0]
+        try:
+            result = {"city": city, **analyze_json(load_data(input_path))}
+        except Exception as ex:
+            logging.error(f"Failed analyzing {input_path}: {ex}")
+            result = {"city": city, "error": str(ex)}
+        lines.append(json.dumps(result, ensure_ascii=False) + "\n")
+    return lines
+
+
+def analyze_batch(
+    input_paths: List[str],
+    output_path: str,
+    workers: Optional[int] = None,
+    chunk_size: Optional[int] = None,
+) -> int:
+    """
+    Analyzes the files in a process pool and writes every city to `output_path`
+    as soon as its chunk is done, so the order of the lines is not the order of the files
+    """
+    workers = workers or os.cpu_count() or 1
+    if chunk_size is None:
+        # a few chunks per worker keep them busy until the end without paying per-file overhead
+        chunk_size = max(1, min(64, -(-len(input_paths) // (workers * 4))))
+
+    chunks = ((input_paths[i:i + chunk_size],) for i in range(0, len(input_paths), chunk_size))
+    return write_chunks(output_path, analyze_files, chunks, workers)
+
+
+def write_chunks(
+    output_path: str,
+    worker: Callable[..., List[str]],
+    chunks: Iterable[tuple],
+    workers: int,
+) -> int:
+    """
+    Runs worker(*chunk) for every chunk in a process pool and writes its NDJSON lines
+    to `output_path` as soon as the chunk is done. Returns the number of lines.
+    """
+    written = 0
+    with open(output_path, mode="w") as file, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(worker, *chunk) for chunk in chunks]
+        for future in concurrent.futures.as_completed(futures):
+            lines = future.result()
+            file.writelines(lines)
+            written += len(lines)
+    return written
+
+
+def is_store_input(input_path: str) -> bool:
+    return input_path.endswith(STORE_SUFFIX)
+
+
+def forecast_store():
+    """external/forecast_store.py, numpy is imported for the store input only"""
+    if __package__:
+        from external import forecast_store
+    else:
+        # run as a script: python3 external/analyzer.py
+        import forecast_store
+    return forecast_store
+
+
+def analyze_store_city(store, city: str) -> dict:
+    """analyze_json of the payload the city had before it was put into the ForecastStore"""
+    days = []
+    for date, hours, temps, conditions in store.days(city):
+        day_hours = (
+            hour_data for hour_data in zip(hours, temps, conditions)
+            if INPUT_DAY_HOURS_START <= hour_data[0] <= INPUT_DAY_HOURS_END
+        )
+        days.append(day_record(date, day_hours).to_json())
+    result = dict(DEFAULT_OUTPUT_RESULT)
     result[OUTPUT_DAYS_KEY] = days
     return result
 
 
+def analyze_store_cities(store_path: str, mtime_ns: int, cities: List[str]) -> List[str]:
+    """Runs in a worker process, which maps the store file instead of receiving the forecasts"""
+    store = forecast_store().open_shared(store_path, mtime_ns)
+    lines = []
+    for city in cities:
+        if city in store.failed:
+            result = {"city": city, "error": "Broken forecasts"}
+        else:
+            result = {"city": city, **analyze_store_city(store, city)}
+        lines.append(json.dumps(result, ensure_ascii=False) + "\n")
+    return lines
+
+
+def analyze_store(
+    store_path: str,
+    output_path: str,
+    workers: Optional[int] = None,
+    chunk_size: Optional[int] = None,
+) -> int:
+    """analyze_batch over the cities of a ForecastStore file, failed cities get an error line"""
+    store = forecast_store().ForecastStore.open(store_path)
+    cities = store.cities + sorted(store.failed)
+    mtime_ns = os.stat(store_path).st_mtime_ns
+    workers = workers or os.cpu_count() or 1
+    if chunk_size is None:
+        chunk_size = max(1, -(-len(cities) // (workers * 4)))
+
+    chunks = ((store_path, mtime_ns, cities[i:i + chunk_size]) for i in range(0, len(cities), chunk_size))
+    return write_chunks(output_path, analyze_store_cities, chunks, workers)
+
+
 if __name__ == "__main__":
     args = parse_args()
     input_path = args.input
@@ -211,7 +422,14 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG if verbose_mode else logging.WARNING)
     logging.info(args)
 
-    data = load_data(input_path)
-    data = analyze_json(data)
-
-    dump_data(data, output_path)
+    if is_batch_input(input_path):
+        # one json line per file: {"city": ..., "days": [...]}
+        analyze_batch(find_input_files(input_path), output_path, workers=args.jobs)
+    elif is_store_input(input_path):
+        # one json line per city of the store
+        analyze_store(input_path, output_path, workers=args.jobs)
+    else:
+        data = load_data(input_path)
+        data = analyze_json(data)
+
+        dump_data(data, output_path)
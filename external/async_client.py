@@ -0,0 +1,223 @@
+import asyncio
+import json
+import logging
+import ssl
+from collections import defaultdict
+from http import HTTPStatus
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from external.cache import ResponseCache
+from external.client import ERR_MESSAGE_TEMPLATE, FetchError, is_retryable, status_error
+from external.stream_parser import loads_forecasts
+
+if TYPE_CHECKING:
+    from metrics import Metrics
+
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_MAX_IDLE_PER_HOST = 10
+
+logger = logging.getLogger()
+
+HostKey = Tuple[str, str, int]
+Connection = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+class ConnectionPool:
+    """
+    Idle keep-alive connections grouped by (scheme, host, port)
+    """
+
+    def __init__(self, max_idle_per_host: int = DEFAULT_MAX_IDLE_PER_HOST):
+        self.max_idle_per_host = max_idle_per_host
+        self._idle: Dict[HostKey, List[Connection]] = defaultdict(list)
+        self._ssl_context: Optional[ssl.SSLContext] = None
+        self.opened = 0
+        self.reused = 0
+
+    async def acquire(self, key: HostKey) -> Tuple[Connection, bool]:
+        """Returns a connection and a flag telling whether it was taken from the pool"""
+        idle = self._idle[key]
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                self.reused += 1
+                return (reader, writer), True
+            writer.close()
+
+        scheme, host, port = key
+        ssl_context = None
+        if scheme == "https":
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            ssl_context = self._ssl_context
+        connection = await asyncio.open_connection(host, port, ssl=ssl_context)
+        self.opened += 1
+        return connection, False
+
+    def release(self, key: HostKey, connection: Connection, reusable: bool):
+        idle = self._idle[key]
+        if reusable and len(idle) < self.max_idle_per_host:
+            idle.append(connection)
+        else:
+            connection[1].close()
+
+    async def close(self):
+        writers = [writer for idle in self._idle.values() for _, writer in idle]
+        self._idle.clear()
+        for writer in writers:
+            writer.close()
+        for writer in writers:
+            try:
+                await writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
+
+
+async def _read_body(reader: asyncio.StreamReader, status: int, headers: Dict[str, str]) -> Tuple[bytes, bool]:
+    """Reads response body, the flag tells whether the connection can be reused"""
+    if status in (HTTPStatus.NO_CONTENT, HTTPStatus.NOT_MODIFIED):
+        return b"", True
+
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size_line = await reader.readline()
+            size = int(size_line.split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                # trailers
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        return b"".join(chunks), True
+
+    if "content-length" in headers:
+        return await reader.readexactly(int(headers["content-length"])), True
+
+    return await reader.read(), False
+
+
+class AsyncYandexWeatherAPI:
+    """
+    Asyncio requests with keep-alive connections reused between cities
+    """
+
+    def __init__(
+        self,
+        timeout: float = DEFAULT_TIMEOUT,
+        max_idle_per_host: int = DEFAULT_MAX_IDLE_PER_HOST,
+        cache: Optional[ResponseCache] = None,
+        streaming: bool = False,
+        metrics: Optional["Metrics"] = None,
+    ):
+        self.timeout = timeout
+        self.cache = cache
+        self.streaming = streaming
+        self.metrics = metrics
+        self.pool = ConnectionPool(max_idle_per_host=max_idle_per_host)
+
+    async def __aenter__(self) -> "AsyncYandexWeatherAPI":
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self.pool.close()
+
+    @staticmethod
+    def _host_key(url: str) -> Tuple[HostKey, str]:
+        parts = urlsplit(url)
+        scheme = parts.scheme or "http"
+        port = parts.port or (443 if scheme == "https" else 80)
+        target = parts.path or "/"
+        if parts.query:
+            target = f"{target}?{parts.query}"
+        return (scheme, parts.hostname or "", port), target
+
+    async def _exchange(
+        self, connection: Connection, host: str, target: str, headers: Dict[str, str]
+    ) -> Tuple[int, Dict[str, str], bytes, bool]:
+        reader, writer = connection
+        extra_headers = "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        writer.write(
+            (
+                f"GET {target} HTTP/1.1\r\n"
+                f"Host: {host}\r\n"
+                "Accept-Encoding: identity\r\n"
+                "Connection: keep-alive\r\n"
+                f"{extra_headers}"
+                "\r\n"
+            ).encode("latin-1")
+        )
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by server")
+        version, status, *_ = status_line.decode("latin-1").split(" ", 2)
+
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        body, reusable = await _read_body(reader, int(status), response_headers)
+        connection_header = response_headers.get("connection", "").lower()
+        if connection_header == "close" or (version == "HTTP/1.0" and connection_header != "keep-alive"):
+            reusable = False
+        return int(status), response_headers, body, reusable
+
+    async def request(self, url: str, headers: Optional[Dict[str, str]] = None) -> Tuple[int, Dict[str, str], bytes]:
+        """
+        :return: status, response headers with lower-cased names and body
+        """
+        key, target = self._host_key(url)
+        host = key[1] if key[2] in (80, 443) else f"{key[1]}:{key[2]}"
+        while True:
+            connection, from_pool = await self.pool.acquire(key)
+            try:
+                status, response_headers, body, reusable = await self._exchange(
+                    connection, host, target, headers or {}
+                )
+            except (ConnectionError, asyncio.IncompleteReadError):
+                connection[1].close()
+                if from_pool:
+                    # The server dropped an idle keep-alive connection, retry on a new one
+                    continue
+                raise
+            except BaseException:
+                connection[1].close()
+                raise
+            self.pool.release(key, connection, reusable)
+            return status, response_headers, body
+
+    async def _do_req(self, url: str) -> Tuple[int, bytes]:
+        if self.cache is None:
+            status, _, body = await self.request(url)
+            return status, body
+        return await self.cache.afetch(url, lambda headers: self.request(url, headers))
+
+    async def get_forecasting(self, url: str, timeout: Optional[float] = None) -> dict:
+        """
+        :param url: url_to_json_data as str
+        :param timeout: deadline of the whole request, `self.timeout` by default
+        :return: response data as json
+        """
+        try:
+            status, body = await asyncio.wait_for(self._do_req(url), timeout=timeout or self.timeout)
+            if status != HTTPStatus.OK:
+                raise status_error(status)
+            if self.metrics is not None:
+                self.metrics.observe("payload_bytes", len(body))
+            return loads_forecasts(body) if self.streaming else json.loads(body)
+        except Exception as ex:
+            logger.error(ex)
+            # asyncio.TimeoutError is not a TimeoutError before Python 3.11
+            retryable = isinstance(ex, asyncio.TimeoutError) or is_retryable(ex)
+            raise FetchError(ERR_MESSAGE_TEMPLATE.format(error=ex), retryable=retryable)
@@ -0,0 +1,224 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from email.utils import formatdate
+from http import HTTPStatus
+from typing import Awaitable, Callable, Dict, Mapping, NamedTuple, Optional, Tuple
+
+DEFAULT_CACHE_PATH = "./.weather-cache/responses.sqlite3"
+DEFAULT_TTL = 300.0
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+Response = Tuple[int, Mapping[str, str], bytes]
+Opener = Callable[[Dict[str, str]], Response]
+AsyncOpener = Callable[[Dict[str, str]], Awaitable[Response]]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    stored_at REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    -- the body is the last column so that scans over metadata do not walk its overflow pages
+    body BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);
+CREATE TABLE IF NOT EXISTS totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    size INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO totals VALUES (0, 0);
+CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses
+BEGIN
+    UPDATE totals SET size = size + NEW.size;
+END;
+CREATE TRIGGER IF NOT EXISTS responses_update AFTER UPDATE OF size ON responses
+BEGIN
+    UPDATE totals SET size = size + NEW.size - OLD.size;
+END;
+CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses
+BEGIN
+    UPDATE totals SET size = size - OLD.size;
+END;
+"""
+
+
+def _header(headers: Mapping[str, str], name: str) -> Optional[str]:
+    return headers.get(name) or headers.get(name.lower())
+
+
+class CacheEntry(NamedTuple):
+    body: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+    stored_at: float
+
+
+class ResponseCache:
+    """
+    On-disk cache of raw responses keyed by url.
+
+    Fresh entries (younger than `ttl`) are served without a request, stale ones are
+    revalidated with If-None-Match/If-Modified-Since. The least recently used entries
+    are evicted once the stored bodies exceed `max_bytes`. SQLite locking makes the
+    cache safe to share between threads and processes.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_PATH,
+        ttl: float = DEFAULT_TTL,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # SQLite busy-waits on lock conflicts, so writers of one process take turns here first
+        self._write_lock = threading.Lock()
+        self._counters = dict.fromkeys(
+            ("hits", "revalidated", "misses", "stores", "evictions", "bytes_saved"), 0
+        )
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters)
+
+    def lookup(self, url: str) -> Optional[CacheEntry]:
+        row = self._connection().execute(
+            "SELECT body, etag, last_modified, stored_at FROM responses WHERE url = ?", (url,)
+        ).fetchone()
+        return CacheEntry(*row) if row else None
+
+    def is_fresh(self, entry: CacheEntry) -> bool:
+        return time.time() - entry.stored_at < self.ttl
+
+    @staticmethod
+    def validators(entry: Optional[CacheEntry]) -> Dict[str, str]:
+        """Conditional request headers for a stale entry"""
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+            elif not entry.etag:
+                headers["If-Modified-Since"] = formatdate(entry.stored_at, usegmt=True)
+        return headers
+
+    def _touch(self, url: str, revalidated: bool = False):
+        now = time.time()
+        if revalidated:
+            query, params = "UPDATE responses SET accessed_at = ?, stored_at = ? WHERE url = ?", (now, now, url)
+        else:
+            query, params = "UPDATE responses SET accessed_at = ? WHERE url = ?", (now, url)
+        with self._write_lock:
+            self._connection().execute(query, params)
+
+    def store(self, url: str, body: bytes, headers: Mapping[str, str]):
+        now = time.time()
+        connection = self._connection()
+        with self._write_lock:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(
+                    """
+                    INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (url) DO UPDATE SET
+                        size = excluded.size,
+                        etag = excluded.etag,
+                        last_modified = excluded.last_modified,
+                        stored_at = excluded.stored_at,
+                        accessed_at = excluded.accessed_at,
+                        body = excluded.body
+                    """,
+                    (url, len(body), _header(headers, "ETag"), _header(headers, "Last-Modified"), now, now, body),
+                )
+                evicted = self._evict(connection)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        self._count("stores")
+        self._count("evictions", evicted)
+
+    def _evict(self, connection: sqlite3.Connection) -> int:
+        (total,) = connection.execute("SELECT size FROM totals").fetchone()
+        if total <= self.max_bytes:
+            return 0
+        victims = []
+        for url, size in connection.execute("SELECT url, size FROM responses ORDER BY accessed_at"):
+            if total <= self.max_bytes:
+                break
+            victims.append((url,))
+            total -= size
+        connection.executemany("DELETE FROM responses WHERE url = ?", victims)
+        return len(victims)
+
+    def clear(self):
+        with self._write_lock:
+            self._connection().execute("DELETE FROM responses")
+
+    def _before(self, url: str) -> Tuple[Optional[CacheEntry], bool]:
+        entry = self.lookup(url)
+        if entry is not None and self.is_fresh(entry):
+            self._touch(url)
+            self._count("hits")
+            self._count("bytes_saved", len(entry.body))
+            return entry, True
+        return entry, False
+
+    def _after(self, url: str, entry: Optional[CacheEntry], response: Response) -> Tuple[int, bytes]:
+        status, headers, body = response
+        if status == HTTPStatus.NOT_MODIFIED and entry is not None:
+            self._touch(url, revalidated=True)
+            self._count("revalidated")
+            self._count("bytes_saved", len(entry.body))
+            return HTTPStatus.OK, entry.body
+        self._count("misses")
+        if status == HTTPStatus.OK:
+            self.store(url, body, headers)
+        return status, body
+
+    def fetch(self, url: str, opener: Opener) -> Tuple[int, bytes]:
+        """
+        :param opener: performs the request with the given extra headers
+        :return: status and body, taken from the cache when possible
+        """
+        entry, fresh = self._before(url)
+        if fresh:
+            return HTTPStatus.OK, entry.body
+        return self._after(url, entry, opener(self.validators(entry)))
+
+    async def afetch(self, url: str, opener: AsyncOpener) -> Tuple[int, bytes]:
+        """
+        Same as `fetch` for a coroutine opener.
+        SQLite calls run in threads: waiting for the lock of another process must not stop the event loop.
+        """
+        entry, fresh = await asyncio.to_thread(self._before, url)
+        if fresh:
+            return HTTPStatus.OK, entry.body
+        response = await opener(self.validators(entry))
+        return await asyncio.to_thread(self._after, url, entry, response)
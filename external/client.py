@@ -1,40 +1,121 @@
+import http.client
 import json
 import logging
 from http import HTTPStatus
-from urllib.request import urlopen
+from typing import TYPE_CHECKING, Dict, Mapping, Optional, Tuple
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+from external.stream_parser import loads_forecasts, parse_forecasts
+
+if TYPE_CHECKING:
+    from external.cache import ResponseCache
+    from metrics import Metrics
 
 ERR_MESSAGE_TEMPLATE = "Unexpected error: {error}"
+RETRYABLE_STATUSES = frozenset({
+    HTTPStatus.REQUEST_TIMEOUT,
+    HTTPStatus.TOO_EARLY,
+    HTTPStatus.TOO_MANY_REQUESTS,
+    HTTPStatus.INTERNAL_SERVER_ERROR,
+    HTTPStatus.BAD_GATEWAY,
+    HTTPStatus.SERVICE_UNAVAILABLE,
+    HTTPStatus.GATEWAY_TIMEOUT,
+})
 
 
 logger = logging.getLogger()
 
 
+class FetchError(Exception):
+    """
+    Raised by the clients, `retryable` tells whether another attempt may succeed
+    """
+
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def is_retryable(ex: BaseException) -> bool:
+    """Timeouts, dropped connections and 5xx/429 responses, not 404 or a broken body"""
+    if isinstance(ex, FetchError):
+        return ex.retryable
+    if isinstance(ex, HTTPError):
+        return ex.code in RETRYABLE_STATUSES
+    # URLError wraps refused connections and connect timeouts, EOFError is asyncio.IncompleteReadError
+    return isinstance(ex, (URLError, TimeoutError, ConnectionError, EOFError, http.client.HTTPException))
+
+
+def status_error(status: int) -> FetchError:
+    return FetchError(
+        "Error during execute request. Status: {}".format(status), retryable=status in RETRYABLE_STATUSES
+    )
+
+
 class YandexWeatherAPI:
     """
     Base class for requests
     """
 
-    def __do_req(url: str) -> str:
+    def __open(
+        url: str, headers: Optional[Dict[str, str]] = None, timeout: Optional[float] = None
+    ) -> Tuple[int, Mapping[str, str], bytes]:
+        """Raw request, 304 Not Modified is returned instead of being raised"""
+        try:
+            with urlopen(Request(url, headers=headers or {}), timeout=timeout) as response:
+                return response.status, response.headers, response.read()
+        except HTTPError as ex:
+            if ex.code == HTTPStatus.NOT_MODIFIED:
+                return ex.code, ex.headers, b""
+            raise
+
+    def __do_req(
+        url: str,
+        cache: Optional["ResponseCache"] = None,
+        streaming: bool = False,
+        metrics: Optional["Metrics"] = None,
+        timeout: Optional[float] = None,
+    ) -> dict:
         """Base request method"""
         try:
-            with urlopen(url) as response:
-                resp_body = response.read().decode("utf-8")
-                data = json.loads(resp_body)
-            if response.status != HTTPStatus.OK:
-                raise Exception(
-                    "Error during execute request. {}: {}".format(
-                        resp_body.status, resp_body.reason
-                    )
-                )
-            return data
+            if streaming and cache is None:
+                with urlopen(url, timeout=timeout) as response:
+                    if response.status != HTTPStatus.OK:
+                        raise status_error(response.status)
+                    content_length = response.headers.get("Content-Length")
+                    if metrics is not None and content_length is not None:
+                        metrics.observe("payload_bytes", int(content_length))
+                    return parse_forecasts(response)
+
+            if cache is None:
+                status, _, resp_body = YandexWeatherAPI.__open(url, timeout=timeout)
+            else:
+                status, resp_body = cache.fetch(url, lambda headers: YandexWeatherAPI.__open(url, headers, timeout))
+            if status != HTTPStatus.OK:
+                raise status_error(status)
+            if metrics is not None:
+                metrics.observe("payload_bytes", len(resp_body))
+            return loads_forecasts(resp_body) if streaming else json.loads(resp_body)
         except Exception as ex:
             logger.error(ex)
-            raise Exception(ERR_MESSAGE_TEMPLATE.format(error=ex))
+            raise FetchError(ERR_MESSAGE_TEMPLATE.format(error=ex), retryable=is_retryable(ex))
 
     @staticmethod
-    def get_forecasting(url: str):
+    def get_forecasting(
+        url: str,
+        cache: Optional["ResponseCache"] = None,
+        streaming: bool = False,
+        metrics: Optional["Metrics"] = None,
+        timeout: Optional[float] = None,
+    ):
         """
         :param url: url_to_json_data as str
+        :param cache: optional on-disk cache of responses
+        :param streaming: keep only forecasts[].date and hours[].hour/temp/condition,
+            the body is parsed while it is being read
+        :param metrics: collects the sizes of response bodies as "payload_bytes"
+        :param timeout: seconds to wait for the connection and for every read, None waits forever
         :return: response data as json
         """
-        return YandexWeatherAPI.__do_req(url)
+        return YandexWeatherAPI.__do_req(url, cache, streaming, metrics, timeout)
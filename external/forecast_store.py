@@ -0,0 +1,312 @@
+"""
+Compact columnar copy of the forecasts: hour (int8), temperature (int16) and condition code (uint8)
+of every hour, indexed by city and date. A few bytes per hour instead of the dicts of the decoded json,
+and a saved store is memory-mapped, so the pool workers read the pages of one file instead of
+unpickling the payloads of their cities.
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+from functools import lru_cache
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+CONDITIONS_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "examples", "conditions.txt"
+)
+STORE_MAGIC = b"FCSTORE\0"
+STORE_VERSION = 1
+# columns start at multiples of a cache line in the file
+ALIGNMENT = 64
+
+# per hour
+HOUR_COLUMNS = ("hour", "temp", "condition")
+# "date" per day, "day_start" - first hour of every day and one past the last, "city_start" - the same for days
+COLUMNS = HOUR_COLUMNS + ("date", "day_start", "city_start")
+
+logger = logging.getLogger()
+
+# date, hours, temperatures, conditions of one day as plain Python values
+Day = Tuple[str, List[int], List[int], List[str]]
+
+
+@lru_cache(maxsize=None)
+def load_conditions(path: str = CONDITIONS_PATH) -> Tuple[str, ...]:
+    """Condition values of the API in the order of examples/conditions.txt, their index is the code"""
+    with open(path, encoding="utf-8") as file:
+        lines = file.read().splitlines()
+    return tuple(line.split("—")[0].strip() for line in lines if "—" in line)
+
+
+def narrow(values: list, dtype, name: str) -> np.ndarray:
+    """Integers of the payload as `dtype`, refusing the values it can not hold exactly"""
+    array = np.array(values) if values else np.empty(0, dtype=np.int64)
+    if array.dtype.kind not in "iu":
+        raise TypeError(f"Not integer values of {name}")
+    limits = np.iinfo(dtype)
+    if array.size and (array.min() < limits.min or array.max() > limits.max):
+        raise ValueError(f"Values of {name} out of the {np.dtype(dtype).name} range")
+    return array.astype(dtype)
+
+
+def offsets(sizes: np.ndarray) -> np.ndarray:
+    """[0, size0, size0 + size1, ...]"""
+    result = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=result[1:])
+    return result
+
+
+def gather_ranges(starts: np.ndarray, items: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Indices of the ranges starts[item]:starts[item + 1] of all `items` and the length of each range"""
+    first, lengths = starts[items], starts[items + 1] - starts[items]
+    within = np.arange(lengths.sum(), dtype=np.int64) - np.repeat(offsets(lengths)[:-1], lengths)
+    return np.repeat(first, lengths) + within, lengths
+
+
+class Interned:
+    """Codes of the distinct values, a new value gets the next one"""
+
+    def __init__(self, values: Iterable, dtype):
+        self.values = list(values)
+        self.codes = {value: code for code, value in enumerate(self.values)}
+        self.limit = np.iinfo(dtype).max + 1
+
+    def encode(self, values: list) -> list:
+        codes = self.codes
+        # in the order of appearance, the same payloads give the same codes
+        for value in dict.fromkeys(values):
+            if value in codes:
+                continue
+            if len(self.values) == self.limit:
+                raise ValueError(f"More than {self.limit} distinct values: {value!r}")
+            codes[value] = len(self.values)
+            self.values.append(value)
+        return [codes[value] for value in values]
+
+
+class ForecastStore:
+    """
+    Hours of all cities in flat typed columns, the hours of a day and the days of a city are contiguous.
+    Cities whose payload could not be encoded are listed in `failed`, a city without forecasts is left out.
+    """
+
+    def __init__(
+        self,
+        cities: Sequence[str],
+        dates: Sequence[str],
+        conditions: Sequence[str],
+        columns: Dict[str, np.ndarray],
+        failed: Iterable[str] = (),
+        path: Optional[str] = None,
+    ):
+        self.cities = list(cities)
+        self.positions = {city: i for i, city in enumerate(self.cities)}
+        self.dates = list(dates)
+        self.conditions = list(conditions)
+        self.failed = set(failed)
+        # the file the columns are mapped from, None for a store in memory
+        self.path = path
+        self.hour: np.ndarray = columns["hour"]
+        self.temp: np.ndarray = columns["temp"]
+        self.condition: np.ndarray = columns["condition"]
+        self.date: np.ndarray = columns["date"]
+        self.day_start: np.ndarray = columns["day_start"]
+        self.city_start: np.ndarray = columns["city_start"]
+
+    @classmethod
+    def from_info(cls, info: Dict[str, dict]) -> "ForecastStore":
+        """From the decoded payloads of DataFetchingTask.weather_info"""
+        builder = ForecastStoreBuilder()
+        for city, city_data in info.items():
+            builder.add(city, city_data)
+        return builder.build()
+
+    @property
+    def columns(self) -> Dict[str, np.ndarray]:
+        return {column: getattr(self, column) for column in COLUMNS}
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self.columns.values())
+
+    def __len__(self) -> int:
+        return len(self.cities)
+
+    def __contains__(self, city: str) -> bool:
+        return city in self.positions
+
+    def __iter__(self):
+        return iter(self.cities)
+
+    def days(self, city: str) -> List[Day]:
+        """(date, hours, temperatures, conditions) of every day of the city, KeyError for an unknown city"""
+        position = self.positions[city]
+        first_day, end_day = int(self.city_start[position]), int(self.city_start[position + 1])
+        starts = self.day_start[first_day:end_day + 1].tolist()
+        first, end = starts[0], starts[-1]
+        hours = self.hour[first:end].tolist()
+        temps = self.temp[first:end].tolist()
+        conditions = [self.conditions[code] for code in self.condition[first:end].tolist()]
+        return [
+            (self.dates[date], hours[start - first:stop - first], temps[start - first:stop - first],
+             conditions[start - first:stop - first])
+            for date, start, stop in zip(self.date[first_day:end_day].tolist(), starts, starts[1:])
+        ]
+
+    def select(self, cities: Iterable[str]) -> "ForecastStore":
+        """
+        Store in memory with the given cities only, in their order; the failed ones stay failed,
+        the unknown ones are left out. Small enough to be sent to a worker process.
+        """
+        cities = list(dict.fromkeys(cities))
+        selected = [city for city in cities if city in self.positions]
+        positions = np.array([self.positions[city] for city in selected], dtype=np.int64)
+        day_index, days_per_city = gather_ranges(self.city_start, positions)
+        hour_index, hours_per_day = gather_ranges(self.day_start, day_index)
+        columns = {column: getattr(self, column)[hour_index] for column in HOUR_COLUMNS}
+        columns["date"] = self.date[day_index]
+        columns["day_start"] = offsets(hours_per_day)
+        columns["city_start"] = offsets(days_per_city)
+        return ForecastStore(
+            selected, self.dates, self.conditions, columns, failed=[city for city in cities if city in self.failed]
+        )
+
+    def __reduce__(self):
+        if self.path is None:
+            return ForecastStore, (self.cities, self.dates, self.conditions, self.columns, self.failed)
+        # a worker process maps the same file instead of receiving a copy of the columns
+        return open_shared, (self.path, os.stat(self.path).st_mtime_ns)
+
+    def header(self, columns: Dict[str, dict]) -> bytes:
+        return json.dumps({
+            "version": STORE_VERSION,
+            "cities": self.cities,
+            "dates": self.dates,
+            "conditions": self.conditions,
+            "failed": sorted(self.failed),
+            "columns": columns,
+        }, ensure_ascii=False).encode("utf-8")
+
+    def save(self, path: str) -> str:
+        """One file: magic, header length, json header, then every column aligned to ALIGNMENT"""
+        arrays = self.columns
+        # the header holds the offsets of the columns, which depend on the length of the header
+        layout = {
+            column: {"dtype": array.dtype.str, "length": len(array), "offset": 0} for column, array in arrays.items()
+        }
+        while True:
+            position = len(STORE_MAGIC) + 8 + len(self.header(layout))
+            changed = False
+            for column, array in arrays.items():
+                position = -(-position // ALIGNMENT) * ALIGNMENT
+                changed = changed or layout[column]["offset"] != position
+                layout[column]["offset"] = position
+                position += array.nbytes
+            if not changed:
+                break
+        header = self.header(layout)
+
+        # imported here: external/analyzer.py run as a script only opens stores, without the project on its path
+        from writers import atomic_file
+
+        with atomic_file(path) as file:
+            file.write(STORE_MAGIC + struct.pack("<Q", len(header)) + header)
+            for column, array in arrays.items():
+                file.write(b"\0" * (layout[column]["offset"] - file.tell()))
+                file.write(np.ascontiguousarray(array).tobytes())
+        return path
+
+    @classmethod
+    def open(cls, path: str) -> "ForecastStore":
+        """Read-only columns over a memory map of the file, the pages are shared by all processes"""
+        with open(path, "rb") as file:
+            if file.read(len(STORE_MAGIC)) != STORE_MAGIC:
+                raise ValueError(f"Not a forecast store: {path}")
+            (header_size,) = struct.unpack("<Q", file.read(8))
+            header = json.loads(file.read(header_size))
+            if header.get("version") != STORE_VERSION:
+                raise ValueError(f"Unsupported forecast store version in {path}: {header.get('version')}")
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        columns = {
+            column: np.frombuffer(buffer, dtype=layout["dtype"], count=layout["length"], offset=layout["offset"])
+            for column, layout in header["columns"].items()
+        }
+        return cls(header["cities"], header["dates"], header["conditions"], columns, header["failed"], path=path)
+
+
+@lru_cache(maxsize=4)
+def open_shared(path: str, mtime_ns: int) -> ForecastStore:
+    """ForecastStore.open once per process and version of the file"""
+    return ForecastStore.open(path)
+
+
+class ForecastStoreBuilder:
+    """
+    Encodes the payloads one city at a time, so that the decoded json can be dropped right away.
+    Safe to call from several fetching threads.
+    """
+
+    def __init__(self):
+        self.dates = Interned((), np.uint16)
+        self.conditions = Interned(load_conditions(), np.uint8)
+        # city -> date, hours per day, hour, temp and condition columns
+        self.encoded: Dict[str, Tuple[np.ndarray, ...]] = {}
+        self.failed = set()
+        self.lock = Lock()
+
+    def add(self, city: str, city_data: dict) -> bool:
+        """False for a payload without forecasts or with broken hours, it is logged and left out"""
+        try:
+            forecasts = city_data["forecasts"]
+        except (KeyError, TypeError):
+            logger.error(f"Failed forecasts data extraction for: {city}")
+            return False
+        try:
+            dates, sizes, hours, temps, conditions = [], [], [], [], []
+            for forecast_ in forecasts:
+                day_hours = forecast_["hours"]
+                dates.append(forecast_["date"])
+                sizes.append(len(day_hours))
+                for hourly_data in day_hours:
+                    hours.append(int(hourly_data["hour"]))
+                    temps.append(hourly_data["temp"])
+                    conditions.append(hourly_data["condition"])
+            hour, temp = narrow(hours, np.int8, "hour"), narrow(temps, np.int16, "temp")
+            with self.lock:
+                date = np.array(self.dates.encode(dates), dtype=np.uint16)
+                condition = np.array(self.conditions.encode(conditions), dtype=np.uint8)
+        except (KeyError, TypeError, ValueError) as ex:
+            logger.error(f"Failed encoding forecasts for: {city}: {ex!r}")
+            with self.lock:
+                self.failed.add(city)
+                self.encoded.pop(city, None)
+            return False
+        with self.lock:
+            self.failed.discard(city)
+            self.encoded[city] = (date, np.array(sizes, dtype=np.int64), hour, temp, condition)
+        return True
+
+    def build(self) -> ForecastStore:
+        with self.lock:
+            cities = list(self.encoded)
+            parts = list(zip(*self.encoded.values())) or [()] * 5
+            failed = set(self.failed)
+            dates, conditions = list(self.dates.values), list(self.conditions.values)
+
+        def concatenate(arrays, dtype) -> np.ndarray:
+            return np.concatenate(arrays).astype(dtype, copy=False) if arrays else np.empty(0, dtype=dtype)
+
+        date, sizes, hour, temp, condition = parts
+        columns = {
+            "hour": concatenate(hour, np.int8),
+            "temp": concatenate(temp, np.int16),
+            "condition": concatenate(condition, np.uint8),
+            "date": concatenate(date, np.uint16),
+            "day_start": offsets(concatenate(sizes, np.int64)),
+            "city_start": offsets(np.array([len(city_date) for city_date in date], dtype=np.int64)),
+        }
+        return ForecastStore(cities, dates, conditions, columns, failed)
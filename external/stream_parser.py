@@ -0,0 +1,156 @@
+import codecs
+import json
+from io import BytesIO
+from typing import Any, BinaryIO, Dict, Iterator, List
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+FORECASTS_KEY = "forecasts"
+DATE_KEY = "date"
+HOURS_KEY = "hours"
+HOUR_FIELDS = ("hour", "temp", "condition")
+
+_WHITESPACE = " \t\n\r"
+# characters a number can go on with after a complete shorter number: "12" of "12.5", "1.5" of "1.5e+3"
+_NUMBER_TAIL = ".eE+-"
+_DECODER = json.JSONDecoder()
+
+
+class _Lexer:
+    """
+    Pull reader over a byte stream which keeps only a small window of the input in memory.
+
+    Containers are walked key by key, while single values are decoded by the C scanner
+    of the json module once they are complete in the window.
+    """
+
+    def __init__(self, fp: BinaryIO, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.read = fp.read
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            # raises on a multibyte sequence cut by the end of the stream
+            self.decoder.decode(b"", final=True)
+            return False
+        self.buf = self.buf[self.pos:] + self.decoder.decode(chunk)
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON input")
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r}, got {self.buf[self.pos]!r}")
+        self.pos += 1
+
+    def read_value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # the value is not complete in the window yet
+                if not self.fill():
+                    raise
+                continue
+            # a number may continue in the next chunk
+            if (end < len(self.buf) and self.buf[end] not in _NUMBER_TAIL) or not self.fill():
+                self.pos = end
+                return value
+
+    def iter_object(self) -> Iterator[str]:
+        """Yields keys, the caller has to consume every value"""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(":")
+            yield key
+            if self.peek() == ",":
+                self.pos += 1
+                continue
+            self.expect("}")
+            return
+
+    def iter_array(self) -> Iterator[None]:
+        """Yields once per item, the caller has to consume every item"""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield None
+            if self.peek() == ",":
+                self.pos += 1
+                continue
+            self.expect("]")
+            return
+
+
+def project_day(day: dict) -> dict:
+    """Only the fields used by DataCalculationTask and analyzer.analyze_json"""
+    result = {}
+    if DATE_KEY in day:
+        result[DATE_KEY] = day[DATE_KEY]
+    if HOURS_KEY in day:
+        result[HOURS_KEY] = [
+            {field: hour[field] for field in HOUR_FIELDS if field in hour}
+            for hour in day[HOURS_KEY]
+        ]
+    return result
+
+
+# The parts of the response which are not used (fact, info, the other fields of a day and of every hour)
+# are still decoded by the C scanner and dropped at once: a walk over them in Python takes several times
+# longer than decoding them. Streaming bounds the memory, the time stays about that of json.loads.
+
+
+def iter_forecast_days(fp: BinaryIO, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[dict]:
+    """
+    Streams `forecasts` of a Yandex response, every day is reduced to
+    {"date": ..., "hours": [{"hour": ..., "temp": ..., "condition": ...}, ...]}
+    """
+    lexer = _Lexer(fp, chunk_size)
+    for key in lexer.iter_object():
+        if key == FORECASTS_KEY:
+            for _ in lexer.iter_array():
+                yield project_day(lexer.read_value())
+        else:
+            lexer.read_value()
+
+
+def parse_forecasts(fp: BinaryIO, chunk_size: int = DEFAULT_CHUNK_SIZE) -> dict:
+    """
+    Projection of a Yandex response with the same layout as the full json,
+    so it can be used by DataCalculationTask and analyzer.analyze_json as is
+    """
+    lexer = _Lexer(fp, chunk_size)
+    result: Dict[str, List[dict]] = {}
+    for key in lexer.iter_object():
+        if key == FORECASTS_KEY:
+            result[FORECASTS_KEY] = [project_day(lexer.read_value()) for _ in lexer.iter_array()]
+        else:
+            lexer.read_value()
+    return result
+
+
+def loads_forecasts(data: bytes) -> dict:
+    return parse_forecasts(BytesIO(data))
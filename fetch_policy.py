@@ -0,0 +1,282 @@
+import asyncio
+import concurrent.futures
+import random
+import time
+from collections import deque
+from threading import Lock
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from external.client import FetchError, is_retryable
+from metrics import Metrics
+
+Request = Callable[[str, float], dict]
+AsyncRequest = Callable[[str, float], Awaitable[dict]]
+
+
+class DeadlineExceeded(FetchError):
+    pass
+
+
+class FetchPolicy:
+    """
+    Timeouts, retries and hedging of the city requests
+    """
+
+    def __init__(
+        self,
+        timeout: float = 30.0,
+        retries: int = 2,
+        backoff: float = 0.2,
+        max_backoff: float = 5.0,
+        hedge: bool = False,
+        hedge_quantile: float = 0.95,
+        hedge_delay: float = 1.0,
+        hedge_min_samples: int = 20,
+        deadline: Optional[float] = None,
+    ):
+        """
+        :param timeout: deadline of one attempt
+        :param retries: attempts after the first one, only for timeouts, dropped connections and 5xx/429
+        :param backoff: the n-th retry waits a random time up to min(max_backoff, backoff * 2 ** n)
+        :param hedge: send a duplicate request when the first one is slower than
+            the `hedge_quantile` of the latencies seen so far, the first answer wins
+        :param hedge_delay: delay of the duplicate until `hedge_min_samples` latencies are known
+        :param deadline: seconds for the whole run, the cities not fetched by then are given up
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_delay = hedge_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.deadline = deadline
+
+    def backoff_delay(self, retry: int) -> float:
+        # "full jitter": retries of the cities failed together do not come back together
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** retry))
+
+
+class LatencyTracker:
+    """
+    Quantile of the recent latencies, re-sorted every `refresh` observations only
+    """
+
+    def __init__(self, quantile: float, window: int = 1000, refresh: int = 32):
+        self.quantile = quantile
+        self.values = deque(maxlen=window)
+        self.refresh = refresh
+        self.value: Optional[float] = None
+        self._pending = 0
+
+    def observe(self, latency: float):
+        self.values.append(latency)
+        self._pending += 1
+        if self.value is None or self._pending >= self.refresh:
+            self._pending = 0
+            values = sorted(self.values)
+            self.value = values[min(len(values) - 1, int(len(values) * self.quantile))]
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+class PolicyRunner:
+    """
+    Applies a FetchPolicy to the cities of one run and keeps a report of every city:
+    {"outcome": "ok" | "failed" | "deadline", "attempts": ..., "hedges": ..., "elapsed_s": ..., "error": ...}
+    """
+
+    def __init__(self, policy: FetchPolicy, metrics: Metrics, workers: int):
+        self.policy = policy
+        self.metrics = metrics
+        self.latencies = LatencyTracker(policy.hedge_quantile)
+        self.deadline_at = None if policy.deadline is None else time.monotonic() + policy.deadline
+        self.reports: Dict[str, dict] = {}
+        # attempts given up on keep their thread until the socket timeout, hence the spare ones
+        self.workers = workers * (3 if policy.hedge else 2)
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        # all fetch threads make their first attempt at once, only one of them may create the pool
+        self._executor_lock = Lock()
+
+    @property
+    def executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    self.workers, thread_name_prefix="fetch-attempt"
+                )
+            return self._executor
+
+    def close(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                # do not wait for the attempts given up on
+                self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def remaining(self) -> Optional[float]:
+        return None if self.deadline_at is None else self.deadline_at - time.monotonic()
+
+    def attempt_timeout(self) -> float:
+        remaining = self.remaining()
+        if remaining is None:
+            return self.policy.timeout
+        if remaining <= 0:
+            self.metrics.count("fetch_deadline_exceeded")
+            raise DeadlineExceeded("Run deadline exceeded")
+        return min(self.policy.timeout, remaining)
+
+    def hedge_delay(self) -> Optional[float]:
+        if not self.policy.hedge:
+            return None
+        if len(self.latencies) < self.policy.hedge_min_samples:
+            return self.policy.hedge_delay
+        return self.latencies.value
+
+    def backoff(self, retry: int) -> float:
+        delay = self.policy.backoff_delay(retry)
+        remaining = self.remaining()
+        if remaining is not None and delay >= remaining:
+            self.metrics.count("fetch_deadline_exceeded")
+            raise DeadlineExceeded("Run deadline exceeded")
+        self.metrics.count("fetch_retries")
+        return delay
+
+    def wait_time(self, started: float, timeout: float, hedge_delay: Optional[float], requests: int) -> float:
+        """Until the deadline of the attempt, or until the duplicate request is due"""
+        wait_until = started + timeout
+        if hedge_delay is not None and requests == 1:
+            wait_until = min(wait_until, started + hedge_delay)
+        return max(0.0, wait_until - time.monotonic())
+
+    def answered(self, started: float, hedged: bool):
+        self.latencies.observe(time.monotonic() - started)
+        if hedged:
+            self.metrics.count("fetch_hedge_wins")
+
+    def hedged(self, report: dict):
+        report["hedges"] += 1
+        self.metrics.count("fetch_hedges")
+
+    def new_report(self, city: str) -> dict:
+        report = {"outcome": None, "attempts": 0, "hedges": 0, "elapsed_s": 0.0, "error": None}
+        self.reports[city] = report
+        return report
+
+    def finish(self, report: dict, started: float, ex: Optional[BaseException] = None):
+        report["elapsed_s"] = time.monotonic() - started
+        # all attempts, backoffs and hedges of the city, fetch_attempt_latency_s has the single requests
+        self.metrics.observe("fetch_latency_s", report["elapsed_s"])
+        if ex is None:
+            report["outcome"] = "ok"
+        else:
+            report["outcome"] = "deadline" if isinstance(ex, DeadlineExceeded) else "failed"
+            report["error"] = str(ex)
+
+    def fetch(self, city: str, url: str, request: Request) -> dict:
+        report = self.new_report(city)
+        started = time.monotonic()
+        try:
+            for retry in range(self.policy.retries + 1):
+                timeout = self.attempt_timeout()
+                report["attempts"] += 1
+                try:
+                    data = self.attempt(url, request, timeout, report)
+                except Exception as ex:
+                    if not is_retryable(ex) or retry == self.policy.retries:
+                        raise
+                    report["error"] = str(ex)
+                    time.sleep(self.backoff(retry))
+                else:
+                    self.finish(report, started)
+                    return data
+        except Exception as ex:
+            self.finish(report, started, ex)
+            raise
+
+    def attempt(self, url: str, request: Request, timeout: float, report: dict) -> dict:
+        started = time.monotonic()
+        hedge_delay = self.hedge_delay()
+        futures: List[concurrent.futures.Future] = [self.executor.submit(request, url, timeout)]
+        pending = set(futures)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending,
+                timeout=self.wait_time(started, timeout, hedge_delay, len(futures)),
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                if future.exception() is None:
+                    self.answered(started, hedged=future is not futures[0])
+                    for other in pending:
+                        other.cancel()
+                    return future.result()
+                error = future.exception()
+            if not pending:
+                raise error
+            if done:
+                continue
+            if time.monotonic() >= started + timeout:
+                break
+            futures.append(self.executor.submit(request, url, timeout - (time.monotonic() - started)))
+            pending.add(futures[-1])
+            self.hedged(report)
+        for future in pending:
+            future.cancel()
+        raise FetchError(f"Request took longer than {timeout:.3f}s", retryable=True)
+
+    async def afetch(self, city: str, url: str, request: AsyncRequest) -> dict:
+        """Same as `fetch` for a coroutine request"""
+        report = self.new_report(city)
+        started = time.monotonic()
+        try:
+            for retry in range(self.policy.retries + 1):
+                timeout = self.attempt_timeout()
+                report["attempts"] += 1
+                try:
+                    data = await self.aattempt(url, request, timeout, report)
+                except Exception as ex:
+                    if not is_retryable(ex) or retry == self.policy.retries:
+                        raise
+                    report["error"] = str(ex)
+                    await asyncio.sleep(self.backoff(retry))
+                else:
+                    self.finish(report, started)
+                    return data
+        except Exception as ex:
+            self.finish(report, started, ex)
+            raise
+
+    async def aattempt(self, url: str, request: AsyncRequest, timeout: float, report: dict) -> dict:
+        started = time.monotonic()
+        hedge_delay = self.hedge_delay()
+        tasks = [asyncio.ensure_future(request(url, timeout))]
+        pending = set(tasks)
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=self.wait_time(started, timeout, hedge_delay, len(tasks)),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    if task.exception() is None:
+                        self.answered(started, hedged=task is not tasks[0])
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    raise error
+                if done:
+                    continue
+                if time.monotonic() >= started + timeout:
+                    break
+                tasks.append(asyncio.ensure_future(request(url, timeout - (time.monotonic() - started))))
+                pending.add(tasks[-1])
+                self.hedged(report)
+        finally:
+            for task in pending:
+                task.cancel()
+        raise FetchError(f"Request took longer than {timeout:.3f}s", retryable=True)
@@ -1,3 +1,8 @@
+from typing import TYPE_CHECKING, Dict, Optional
+
+from fetch_policy import FetchPolicy
+from log_progress import logger, setup_logging
+from metrics import Metrics
 from tasks import (
     DataFetchingTask,
     DataCalculationTask,
@@ -5,34 +10,192 @@ from tasks import (
     DataAnalyzingTask,
 )
 from utils import CITIES
+from writers import DEFAULT_RESULTS_PATH
+
+# pandas загружается только при объединении результатов, а не при импорте
+if TYPE_CHECKING:
+    from external.cache import ResponseCache
 
 
-def forecast_weather():
+def forecast_weather(
+    fetch_mode: str = "threads",
+    cache: Optional["ResponseCache"] = None,
+    streaming: bool = False,
+    calc_engine: Optional[str] = None,
+    pipeline: bool = False,
+    cities: Optional[Dict[str, str]] = None,
+    incremental_state: Optional[str] = None,
+    results_path: str = DEFAULT_RESULTS_PATH,
+    results_format: Optional[str] = None,
+    metrics_path: Optional[str] = None,
+    fetch_policy: Optional[FetchPolicy] = None,
+    compact: bool = False,
+):
     """
     Анализ погодных условий по городам
+
+    :param fetch_mode: "threads" - очередь и пул потоков, "async" - asyncio с keep-alive соединениями
+    :param cache: дисковый кэш ответов API между запусками
+    :param streaming: потоковый разбор ответа, сохраняются только используемые поля прогноза
+    :param calc_engine: "process" - процесс на город (по умолчанию), "vectorized" - все города одним проходом numpy,
+        "pool" - пакеты городов в постоянном пуле процессов, каждому процессу передаются только его данные
+    :param pipeline: получение, вычисление и объединение данных выполняются одновременно:
+        каждый город передаётся на вычисление сразу после получения ответа;
+        только с fetch_mode="threads" и calc_engine="pool", без incremental_state и compact
+    :param cities: города и ссылки на прогноз, по умолчанию utils.CITIES
+    :param incremental_state: файл состояния прошлых запусков: пересчитываются только города,
+        прогноз которых изменился
+    :param results_path: файл для сохранения результата
+    :param results_format: csv, ndjson, npz или xlsx, по умолчанию по расширению results_path
+    :param metrics_path: json-файл для снимка метрик запуска: время этапов, задержки и размеры ответов по городам
+    :param fetch_policy: тайм-ауты, повторы, дублирующие запросы и общий срок получения данных
+    :param compact: ответы сразу переводятся в колоночное хранилище ForecastStore вместо json всех городов,
+        память растёт с числом часов прогноза, а не с размером ответов; без pipeline и incremental_state
     """
+    cities = CITIES if cities is None else cities
+    metrics = Metrics()
+    if pipeline:
+        check_pipeline_options(fetch_mode, calc_engine, incremental_state, compact)
+        from pipeline import WeatherPipeline
+
+        weather_pipeline = WeatherPipeline(cache=cache, streaming=streaming, metrics=metrics, policy=fetch_policy)
+        aggregated_data = DataAggregationTask(data=weather_pipeline.weather_analytics)
+        with metrics.stage("pipeline"):
+            aggregated_data.df = weather_pipeline.run(cities=cities)
+        log_fetch_report(weather_pipeline.fetching_task.fetch_report)
+    else:
+        aggregated_data = staged_aggregation(
+            cities, fetch_mode, cache, streaming, calc_engine or "process", incremental_state, metrics, fetch_policy,
+            compact,
+        )
+    with metrics.stage("save"):
+        aggregated_data.save_results(path=results_path, fmt=results_format)
+
+    # Проанализируйте результат и сделайте вывод, какой из городов наиболее благоприятен для поездки.
+    with metrics.stage("analysis"):
+        data_analysis = DataAnalyzingTask(df=aggregated_data.df)
+        best_city = data_analysis.analyze_cities()
+    print(f"Best city(-es): {','.join(best_city)}")
+
+    logger.info(f"Stages: {metrics.stages}")
+    if metrics_path is not None:
+        metrics.dump(metrics_path)
+    return best_city
+
+
+def check_pipeline_options(
+    fetch_mode: str, calc_engine: Optional[str], incremental_state: Optional[str], compact: bool
+):
+    # WeatherPipeline получает данные потоками и считает пакеты в общем пуле процессов, другие режимы не поддерживает
+    if fetch_mode != "threads":
+        raise ValueError(f"Fetch mode {fetch_mode!r} is not supported by the pipeline")
+    if calc_engine not in (None, "pool"):
+        raise ValueError(f"Calculation engine {calc_engine!r} is not supported by the pipeline")
+    if incremental_state is not None:
+        raise ValueError("The incremental state is not supported by the pipeline")
+    if compact:
+        raise ValueError("The compact forecast store is not supported by the pipeline")
+
+
+def staged_aggregation(
+    cities: Dict[str, str],
+    fetch_mode: str,
+    cache: Optional["ResponseCache"],
+    streaming: bool,
+    calc_engine: str,
+    incremental_state: Optional[str] = None,
+    metrics: Optional[Metrics] = None,
+    fetch_policy: Optional[FetchPolicy] = None,
+    compact: bool = False,
+) -> DataAggregationTask:
+    if compact and incremental_state is not None:
+        raise ValueError("The incremental state needs the json payloads, it can not be used with compact")
+    metrics = Metrics() if metrics is None else metrics
+
+    if incremental_state is not None:
+        cities_weather = fetch_forecasts(cities, fetch_mode, cache, streaming, metrics, fetch_policy)
+        from incremental import IncrementalCalculation
 
+        incremental = IncrementalCalculation(state_path=incremental_state, engine=calc_engine)
+        with metrics.stage("incremental"):
+            df = incremental.run(info=cities_weather, cities=list(cities.keys()))
+        metrics.gauge("cities_skipped", incremental.skipped)
+        print(f"Cities skipped as unchanged: {incremental.skipped} of {incremental.skipped + incremental.recomputed}")
+        aggregated_data = DataAggregationTask(data=incremental.weather_analytics)
+        aggregated_data.df = df
+        return aggregated_data
+
+    weather_analytics = fetch_and_calculate(
+        cities, fetch_mode, cache, streaming, calc_engine, metrics, fetch_policy, compact
+    )
+
+    # Объедините полученные данные и сохраните результат в текстовом файле
+    aggregated_data = DataAggregationTask(data=weather_analytics)
+    with metrics.stage("aggregation"):
+        aggregated_data.merge_results()
+    return aggregated_data
+
+
+def fetch_forecasts(
+    cities: Dict[str, str],
+    fetch_mode: str,
+    cache: Optional["ResponseCache"],
+    streaming: bool,
+    metrics: Metrics,
+    fetch_policy: Optional[FetchPolicy] = None,
+    compact: bool = False,
+):
+    """Прогнозы городов: словарь ответов или ForecastStore при compact"""
     # Получите информацию о погодных условиях для указанного списка городов
-    cities_weather_data = DataFetchingTask()
-    cities_weather_data.get_cities_weather(cities=CITIES)
-    cities_weather = cities_weather_data.weather_info
+    cities_weather_data = DataFetchingTask(
+        cache=cache, streaming=streaming, metrics=metrics, policy=fetch_policy, compact=compact
+    )
+    with metrics.stage("fetch"):
+        if fetch_mode == "async":
+            cities_weather_data.get_cities_weather_async(cities=cities)
+        elif fetch_mode == "threads":
+            cities_weather_data.get_cities_weather(cities=cities)
+        else:
+            raise ValueError(f"Unknown fetch mode: {fetch_mode}")
+    log_fetch_report(cities_weather_data.fetch_report)
+    cities_weather = cities_weather_data.forecasts
+    if compact:
+        metrics.gauge("forecast_store_bytes", cities_weather.nbytes)
+    return cities_weather
+
+
+def fetch_and_calculate(
+    cities: Dict[str, str],
+    fetch_mode: str,
+    cache: Optional["ResponseCache"],
+    streaming: bool,
+    calc_engine: str,
+    metrics: Optional[Metrics] = None,
+    fetch_policy: Optional[FetchPolicy] = None,
+    compact: bool = False,
+) -> dict:
+    """Показатели по дням для каждого города, без объединения в таблицу и рейтинга"""
+    metrics = Metrics() if metrics is None else metrics
+    cities_weather = fetch_forecasts(cities, fetch_mode, cache, streaming, metrics, fetch_policy, compact)
 
     # Вычислите среднюю температуру и проанализируйте информацию об осадках за указанный период для всех городов
     calculation_task = DataCalculationTask(info=cities_weather)
-    calculation_task.run_concurrent(cities=list(CITIES.keys()))
-    weather_analytics = calculation_task.weather_analytics
+    with metrics.stage("calculation"):
+        calculation_task.run_concurrent(cities=list(cities.keys()), engine=calc_engine)
+    return calculation_task.weather_analytics
 
-    # Объедините полученные данные и сохраните результат в текстовом файле
-    aggregated_data = DataAggregationTask(data=weather_analytics)
-    aggregated_data.merge_results()
-    aggregated_data.save_results()
 
-    # Проанализируйте результат и сделайте вывод, какой из городов наиболее благоприятен для поездки.
-    data_analysis = DataAnalyzingTask(df=aggregated_data.df)
-    best_city = data_analysis.analyze_cities()
-    best_city = ",".join(best_city)
-    print(f"Best city(-es): {best_city}")
+def log_fetch_report(fetch_report: Dict[str, dict]):
+    # Города без данных не попадают в рейтинг, поэтому перечисляются явно
+    failed = {city: report for city, report in fetch_report.items() if report["outcome"] != "ok"}
+    for city, report in failed.items():
+        logger.warning(
+            f"City left out: {city}, {report['outcome']} after {report['attempts']} attempt(s): {report['error']}"
+        )
+    if failed:
+        print(f"Cities left out: {len(failed)} of {len(fetch_report)}, see the log")
 
 
 if __name__ == "__main__":
+    setup_logging()
     forecast_weather()
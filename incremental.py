@@ -0,0 +1,110 @@
+import hashlib
+import json
+from typing import Dict, Iterable, Optional
+
+import pandas as pd
+
+from log_progress import logger
+from tasks import DataAggregationTask, DataCalculationTask
+from writers import atomic_file
+
+DEFAULT_STATE_PATH = "./.weather-cache/incremental-state.json"
+STATE_VERSION = 1
+
+
+def fingerprint(city_data: dict) -> str:
+    # Keys are kept in the order of the response, an identical response gives an identical dump
+    payload = json.dumps(city_data, separators=(",", ":"), ensure_ascii=False, check_circular=False)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class IncrementalState:
+    """
+    Fingerprint, weather_analytics entry and aggregated row of every city from the previous runs
+    """
+
+    def __init__(self, path: str = DEFAULT_STATE_PATH):
+        self.path = path
+        self.cities: Dict[str, dict] = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logger.error(f"Ignoring broken incremental state: {self.path}")
+            return
+        if state.get("version") == STATE_VERSION:
+            self.cities = state["cities"]
+
+    def save(self):
+        with atomic_file(self.path, "w", encoding="utf-8") as file:
+            # json.dumps uses the C encoder, json.dump streams through the pure Python one
+            file.write(json.dumps({"version": STATE_VERSION, "cities": self.cities}))
+
+
+class IncrementalCalculation:
+    """
+    DataCalculationTask and DataAggregationTask.merge_results for the cities whose forecast
+    changed since the previous run only. Statistics of the other cities are taken from the
+    state, only the ranks are rebuilt over the whole per-city table.
+    """
+
+    def __init__(self, state_path: str = DEFAULT_STATE_PATH, engine: str = "pool"):
+        self.state = IncrementalState(state_path)
+        self.engine = engine
+        self.weather_analytics: dict = {}
+        self.skipped = 0
+        self.recomputed = 0
+
+    def run(self, info: dict, cities: Optional[Iterable[str]] = None) -> pd.DataFrame:
+        cities = list(info if cities is None else cities)
+        fingerprints = {city: fingerprint(info[city]) for city in cities if city in info}
+
+        changed = []
+        for city in cities:
+            entry = self.state.cities.get(city)
+            if city in fingerprints and entry is not None and entry["fingerprint"] == fingerprints[city]:
+                if entry["days"] is not None:
+                    self.weather_analytics[city] = entry["days"]
+            else:
+                changed.append(city)
+        self.skipped = len(cities) - len(changed)
+        self.recomputed = len(changed)
+
+        calculation_task = DataCalculationTask(info={city: info[city] for city in changed if city in info})
+        calculation_task.run_concurrent(cities=changed, engine=self.engine)
+        self.weather_analytics.update(calculation_task.weather_analytics)
+
+        daily = DataAggregationTask.process_partly_data(
+            [(city, calculation_task.weather_analytics[city]) for city in changed
+             if city in calculation_task.weather_analytics]
+        )
+        changed_rows = DataAggregationTask.aggregate_cities(daily) if not daily.empty else None
+
+        for city in changed:
+            if city in fingerprints:
+                self.state.cities[city] = {
+                    "fingerprint": fingerprints[city],
+                    "days": calculation_task.weather_analytics.get(city),
+                    "row": None,
+                }
+        if changed_rows is not None:
+            for row in changed_rows.to_dict("records"):
+                self.state.cities[row["city"]]["row"] = {
+                    "avg_temp": row["avg_temp"],
+                    "n_hours_good_weather": row["n_hours_good_weather"],
+                }
+        self.state.save()
+        logger.info(f"Incremental run: {self.recomputed} cities recomputed, {self.skipped} skipped")
+
+        rows = [
+            {"city": city, **self.state.cities[city]["row"]}
+            for city in sorted(set(cities))
+            if city in fingerprints and self.state.cities[city]["row"] is not None
+        ]
+        merged_results = pd.DataFrame(rows, columns=["city", "avg_temp", "n_hours_good_weather"])
+        return DataAggregationTask.add_ranks(merged_results)
@@ -2,15 +2,24 @@ import logging
 import os
 from time import gmtime, strftime
 
-current_time = strftime("%Y_%m_%dT%H_%M_%S", gmtime())
-lgdr = f"./logging/{current_time}"
-os.makedirs(lgdr, exist_ok=True)
-
-log_file = f"{lgdr}/results.log"
-logging.basicConfig(
-    filename=log_file,
-    level=logging.INFO,
-    format="%(asctime)s %(levelname)s %(name)s %(message)s",
-)
+LOGGING_ROOT = "./logging"
 
 logger = logging.getLogger(__name__)
+
+
+def setup_logging(root: str = LOGGING_ROOT) -> str:
+    """
+    Sends the log into a new timestamped directory under `root`.
+    Called by the entry points, importing the tasks creates no files.
+    """
+    current_time = strftime("%Y_%m_%dT%H_%M_%S", gmtime())
+    lgdr = f"{root}/{current_time}"
+    os.makedirs(lgdr, exist_ok=True)
+
+    log_file = f"{lgdr}/results.log"
+    logging.basicConfig(
+        filename=log_file,
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s %(message)s",
+    )
+    return log_file
@@ -0,0 +1,91 @@
+import json
+import time
+from contextlib import contextmanager
+from threading import Lock
+from typing import Dict, Iterator, List
+
+PERCENTILES = (50, 95, 99)
+
+
+class Histogram:
+    """
+    Raw observations, percentiles are computed only when a snapshot is taken
+    """
+
+    def __init__(self):
+        self.values: List[float] = []
+
+    def observe(self, value: float):
+        # list.append is atomic, so worker threads need no lock here
+        self.values.append(value)
+
+    def summary(self) -> dict:
+        values = sorted(self.values)
+        if not values:
+            return {"count": 0}
+        result = {
+            "count": len(values),
+            "min": values[0],
+            "max": values[-1],
+            "mean": sum(values) / len(values),
+        }
+        for percentile in PERCENTILES:
+            # nearest-rank percentile
+            result[f"p{percentile}"] = values[max(0, -(-len(values) * percentile // 100) - 1)]
+        return result
+
+
+class Metrics:
+    """
+    Stage timers, counters, gauges and histograms of one run.
+
+    Recording is a perf_counter call and a list append per event, cheap enough to stay on
+    for every run. CPU time of a stage is the CPU time of this process only: work done
+    in pool workers shows up in the wall time.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, dict] = {}
+        self.counters: Dict[str, int] = {}
+        self.gauges: Dict[str, float] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self._lock = Lock()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        started, cpu_started = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.stages[name] = {
+                "wall_s": time.perf_counter() - started,
+                "cpu_s": time.process_time() - cpu_started,
+            }
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name: str, value: float):
+        self.gauges[name] = value
+
+    def observe(self, name: str, value: float):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        histogram.observe(value)
+
+    def snapshot(self) -> dict:
+        return {
+            "stages": dict(self.stages),
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "histograms": {name: histogram.summary() for name, histogram in list(self.histograms.items())},
+        }
+
+    def dump(self, path: str) -> dict:
+        snapshot = self.snapshot()
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(json.dumps(snapshot, indent=2))
+        return snapshot
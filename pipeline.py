@@ -0,0 +1,211 @@
+import os
+import time
+from queue import Queue
+from threading import BoundedSemaphore, Thread
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from external.cache import ResponseCache
+from fetch_policy import FetchPolicy
+from log_progress import logger
+from metrics import Metrics
+from tasks import (
+    DataAggregationTask,
+    DataFetchingTask,
+    calc_weather_stats_chunk,
+    get_process_pool,
+)
+from weather_stats import kahan_add
+
+_DONE = None
+
+
+class PartialAggregation:
+    """
+    Per-day rows and running per-city totals, updated as soon as a city is calculated.
+    Without keep_rows only the totals are kept and to_frame is not available.
+    """
+
+    def __init__(self, keep_rows: bool = True):
+        self.keep_rows = keep_rows
+        self.rows: List[dict] = []
+        self.totals: Dict[str, dict] = {}
+
+    def add(self, weather_analytics: dict):
+        for city, days in weather_analytics.items():
+            if not days:
+                continue
+            rows = DataAggregationTask.daily_rows([(city, days)])
+            if self.keep_rows:
+                self.rows.extend(rows)
+            totals = self.totals.setdefault(
+                city, {"days": 0, "avg_temp_sum": 0.0, "avg_temp_compensation": 0.0, "n_hours_good_weather": 0}
+            )
+            for row in rows:
+                totals["days"] += 1
+                # compensated like the pandas mean, so that sum / days gives the same ranks as merge_results
+                totals["avg_temp_sum"], totals["avg_temp_compensation"] = kahan_add(
+                    totals["avg_temp_sum"], totals["avg_temp_compensation"], row["avg_temp"]
+                )
+                totals["n_hours_good_weather"] += row["n_hours_good_weather"]
+
+    def snapshot(self) -> Dict[str, dict]:
+        """Current averages of the cities calculated so far"""
+        return {
+            city: {
+                "avg_temp": totals["avg_temp_sum"] / totals["days"],
+                "n_hours_good_weather": totals["n_hours_good_weather"],
+            }
+            for city, totals in self.totals.items()
+        }
+
+    def to_frame(self) -> pd.DataFrame:
+        if not self.keep_rows:
+            raise ValueError("The per-day rows were not kept")
+        return DataAggregationTask.rank_cities(pd.DataFrame(self.rows))
+
+
+class WeatherPipeline:
+    """
+    Fetching, calculation and aggregation running at the same time.
+
+    Fetch threads put every city into a bounded queue as soon as its forecast arrives,
+    a dispatcher sends small chunks of them to the shared process pool and the results
+    are aggregated while the remaining cities are still in flight. Bounded queues and
+    the limit of chunks in flight stop a fast stage from running away from a slow one.
+    """
+
+    def __init__(
+        self,
+        workers: int = 5,
+        chunk_size: int = 8,
+        queue_size: int = 64,
+        max_chunks_in_flight: Optional[int] = None,
+        cache: Optional[ResponseCache] = None,
+        streaming: bool = False,
+        metrics: Optional[Metrics] = None,
+        policy: Optional[FetchPolicy] = None,
+    ):
+        self.fetching_task = DataFetchingTask(
+            workers=workers, cache=cache, streaming=streaming, metrics=metrics, policy=policy
+        )
+        self.metrics = self.fetching_task.metrics
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.max_chunks_in_flight = max_chunks_in_flight or 2 * (os.cpu_count() or 1)
+        self.aggregation = PartialAggregation()
+        self.weather_analytics: dict = {}
+        self.first_result_latency: Optional[float] = None
+        # exceptions of the stage threads, re-raised by run()
+        self.stage_errors: List[BaseException] = []
+
+    def fetch_worker(self, cities: Queue, fetched: Queue):
+        while True:
+            task = cities.get()
+            if task is _DONE:
+                break
+            city, url = task
+            self.metrics.observe("fetch_queue_depth", cities.qsize())
+            try:
+                weather_data = self.fetching_task.fetch_city(city, url)
+                # the bounded queue in front of the calculation, full while the calculation falls behind
+                self.metrics.observe("fetched_queue_depth", fetched.qsize())
+                fetched.put((city, weather_data))
+            except Exception as e:
+                self.metrics.count("fetch_errors")
+                logger.error(f"Failed fetching data for city: {city}")
+                logger.error(f"{str(e)}")
+
+    def fetch_stage(self, cities: dict, fetched: Queue):
+        # the end marker is sent whatever happens, the calculation stage waits for it
+        try:
+            runner = self.fetching_task.start_run()
+            try:
+                queue = Queue()
+                for city, url in cities.items():
+                    queue.put((city, url))
+                threads = [
+                    Thread(target=self.fetch_worker, args=(queue, fetched), daemon=True)
+                    for _ in range(self.fetching_task.workers)
+                ]
+                for thread in threads:
+                    queue.put(_DONE)
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            finally:
+                runner.close()
+        except BaseException as e:
+            self.stage_errors.append(e)
+        finally:
+            fetched.put(_DONE)
+
+    def calc_stage(self, fetched: Queue, calculated: Queue, in_flight: BoundedSemaphore):
+        # the number of submitted chunks is sent whatever happens, run() waits for it
+        submitted = 0
+        done = False
+        try:
+            executor = get_process_pool()
+            while not done:
+                chunk = {}
+                item = fetched.get()
+                while item is not _DONE:
+                    city, data = item
+                    chunk[city] = data
+                    if len(chunk) >= self.chunk_size or fetched.empty():
+                        break
+                    item = fetched.get()
+                done = item is _DONE
+
+                if chunk:
+                    in_flight.acquire()
+                    future = executor.submit(calc_weather_stats_chunk, (list(chunk), chunk))
+                    future.add_done_callback(calculated.put)
+                    submitted += 1
+        except BaseException as e:
+            self.stage_errors.append(e)
+            # the fetch stage must not block on the bounded queue
+            while not done:
+                done = fetched.get() is _DONE
+        finally:
+            calculated.put(submitted)
+
+    def run(self, cities: dict) -> pd.DataFrame:
+        started = time.perf_counter()
+        fetched = Queue(maxsize=self.queue_size)
+        calculated = Queue()
+        in_flight = BoundedSemaphore(self.max_chunks_in_flight)
+
+        stages = [
+            Thread(target=self.fetch_stage, args=(cities, fetched), daemon=True),
+            Thread(target=self.calc_stage, args=(fetched, calculated, in_flight), daemon=True),
+        ]
+        for stage in stages:
+            stage.start()
+
+        received = 0
+        expected = None
+        while expected is None or received < expected:
+            item = calculated.get()
+            if isinstance(item, int):
+                expected = item
+                continue
+            received += 1
+            in_flight.release()
+            try:
+                result = item.result()
+            except Exception as e:
+                logger.error(f"Failed calculating chunk: {str(e)}")
+                continue
+            self.weather_analytics.update(result)
+            self.aggregation.add(result)
+            if self.first_result_latency is None:
+                self.first_result_latency = time.perf_counter() - started
+                self.metrics.gauge("pipeline_first_result_s", self.first_result_latency)
+
+        for stage in stages:
+            stage.join()
+        if self.stage_errors:
+            raise self.stage_errors[0]
+        return self.aggregation.to_frame()
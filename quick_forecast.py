@@ -0,0 +1,97 @@
+"""
+Fast-start forecast with the standard library only: no pandas, no numpy, no log directory.
+Suited for short runs like a check of one city from cron, e.g.
+
+    python3 -m quick_forecast MOSCOW
+    python3 -m quick_forecast --output weather-stats.csv
+
+pandas is imported only for the xlsx output.
+"""
+import argparse
+import concurrent.futures
+import json
+import sys
+from typing import Dict, List, Optional
+
+from external.client import YandexWeatherAPI
+from fetch_policy import FetchPolicy, PolicyRunner
+from metrics import Metrics
+from utils import CITIES
+from weather_stats import add_ranks, aggregate_cities, best_cities, city_stats
+
+COLUMNS = ("city", "avg_temp", "n_hours_good_weather", "rank_temp", "rank_good_hours", "cumulative_rank")
+
+
+def fetch_cities(
+    cities: Dict[str, str], workers: int = 5, policy: Optional[FetchPolicy] = None
+) -> Dict[str, dict]:
+    runner = PolicyRunner(FetchPolicy() if policy is None else policy, Metrics(), workers=workers)
+
+    def fetch(city: str) -> Optional[dict]:
+        try:
+            return runner.fetch(city, cities[city], lambda url, timeout: YandexWeatherAPI.get_forecasting(
+                url, streaming=True, timeout=timeout
+            ))
+        except Exception as ex:
+            print(f"Failed fetching data for city: {city}: {ex}", file=sys.stderr)
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        info = dict(zip(cities, executor.map(fetch, cities)))
+    runner.close()
+    return {city: data for city, data in info.items() if data is not None}
+
+
+def quick_forecast(info: Dict[str, dict]) -> List[dict]:
+    """Ranked rows of DataAggregationTask.merge_results for the fetched forecasts"""
+    weather_analytics = {}
+    for city, city_data in info.items():
+        try:
+            weather_analytics[city] = city_stats(city_data)
+        except (KeyError, TypeError, ZeroDivisionError) as ex:
+            print(f"Failed calculating temperature for: {city}: {ex!r}", file=sys.stderr)
+    return add_ranks(aggregate_cities(weather_analytics))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("cities", nargs="*", help="names from utils.CITIES, all of them by default")
+    parser.add_argument("--cities-file", help="json object of city names and urls instead of utils.CITIES")
+    parser.add_argument("--output", help="csv, ndjson, npz or xlsx file with the ranked table")
+    parser.add_argument("--format", help="format of --output, by its extension by default")
+    parser.add_argument("--workers", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=10.0, help="seconds per attempt")
+    parser.add_argument("--retries", type=int, default=2)
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    all_cities = CITIES
+    if args.cities_file:
+        with open(args.cities_file, encoding="utf-8") as file:
+            all_cities = json.load(file)
+    unknown = [city for city in args.cities if city not in all_cities]
+    if unknown:
+        print(f"Unknown cities: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    cities = {city: all_cities[city] for city in args.cities} if args.cities else all_cities
+
+    info = fetch_cities(cities, args.workers, FetchPolicy(timeout=args.timeout, retries=args.retries))
+    rows = quick_forecast(info)
+    for row in rows:
+        print(
+            f"{row['city']:<16} avg_temp {row['avg_temp']:6.2f}  good hours {row['n_hours_good_weather']:3d}"
+            f"  rank {row['cumulative_rank']}"
+        )
+    if args.output:
+        # writers loads numpy for npz and pandas for xlsx only
+        from writers import write_results
+
+        write_results({column: [row[column] for row in rows] for column in COLUMNS}, args.output, args.format)
+    print(f"Best city(-es): {','.join(best_cities(rows))}")
+    return 0 if len(info) == len(cities) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
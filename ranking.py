@@ -0,0 +1,148 @@
+import heapq
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from tasks import DataAggregationTask
+
+DEFAULT_SCORE = "cumulative_rank"
+# date ranges whose index is kept, the least recently used one is dropped first
+DEFAULT_MAX_RANGES = 32
+
+
+class RankingIndex:
+    """
+    Sorted per-column index over the per-city table of DataAggregationTask.
+
+    Built once in O(n log n), after that:
+        best_cities - the cities of DataAnalyzingTask.analyze_cities, O(number of ties)
+        top_k by one column or by a weighted sum of columns - the threshold algorithm
+            over the sorted columns, usually stops after a few k rows
+        top_k within a subset of cities - O(m log k) for m cities of the subset
+        top_k within a date range - not sub-linear: a new range re-ranks its daily rows and builds
+            its own index in O(n log n), the indexes of the last `max_ranges` ranges are reused
+    """
+
+    def __init__(self, df: pd.DataFrame, daily: Optional[pd.DataFrame] = None, max_ranges: int = DEFAULT_MAX_RANGES):
+        self.cities: List[str] = df["city"].tolist()
+        self.positions: Dict[str, int] = {city: i for i, city in enumerate(self.cities)}
+        numeric = df.select_dtypes("number")
+        # plain lists, indexing them is much cheaper than indexing numpy arrays one by one
+        self.values: Dict[str, list] = {column: numeric[column].tolist() for column in numeric.columns}
+        self.ascending: Dict[str, list] = {
+            column: np.argsort(numeric[column].to_numpy(), kind="stable").tolist() for column in numeric.columns
+        }
+        self.daily = daily
+        self.max_ranges = max_ranges
+        self._ranges: "OrderedDict[Tuple[Optional[str], Optional[str]], RankingIndex]" = OrderedDict()
+
+    @classmethod
+    def from_aggregation(cls, task: DataAggregationTask) -> "RankingIndex":
+        return cls(task.df, task.daily)
+
+    def __len__(self) -> int:
+        return len(self.cities)
+
+    def best_cities(self, by: str = DEFAULT_SCORE) -> List[str]:
+        """Cities with the highest value of `by`, in the order of the table"""
+        order = self.ascending[by]
+        if not order:
+            return []
+        values = self.values[by]
+        best = values[order[-1]]
+        positions = []
+        for position in reversed(order):
+            if values[position] != best:
+                break
+            positions.append(position)
+        return [self.cities[position] for position in sorted(positions)]
+
+    def score(self, position: int, weights: Dict[str, float]) -> float:
+        return sum(weight * self.values[column][position] for column, weight in weights.items())
+
+    def top_k(
+        self,
+        k: int,
+        by: str = DEFAULT_SCORE,
+        weights: Optional[Dict[str, float]] = None,
+        cities: Optional[Iterable[str]] = None,
+        dates: Optional[Tuple[Optional[str], Optional[str]]] = None,
+    ) -> List[Tuple[str, float]]:
+        """
+        :param by: column to rank by, ignored if `weights` are given
+        :param weights: score = sum(weight * column), negative weights prefer low values
+        :param cities: rank only these cities
+        :param dates: (first, last) date, inclusive, None for an open end; needs the daily rows
+        :return: (city, score) pairs, the highest score first, ties in the order of the table
+        """
+        if dates is not None:
+            return self.for_dates(*dates).top_k(k, by=by, weights=weights, cities=cities)
+        weights = {by: 1.0} if weights is None else weights
+        unknown = set(weights) - set(self.values)
+        if unknown:
+            raise ValueError(f"Unknown ranking columns: {', '.join(sorted(unknown))}")
+        if k <= 0:
+            return []
+
+        if cities is not None:
+            positions = (self.positions[city] for city in cities if city in self.positions)
+            best = heapq.nlargest(k, ((self.score(position, weights), -position) for position in positions))
+        else:
+            best = self.threshold_top_k(k, weights)
+        return [(self.cities[-position], score) for score, position in best]
+
+    def threshold_top_k(self, k: int, weights: Dict[str, float]) -> List[Tuple[float, int]]:
+        """
+        Fagin's threshold algorithm: the sorted columns are read row by row, best values first.
+        No unread city can score more than the weighted sum of the values of the current row,
+        so the scan stops once the k-th best score seen exceeds it.
+        """
+        columns = [(column, weight) for column, weight in weights.items() if weight]
+        if not columns:
+            return [(0.0, -position) for position in range(min(k, len(self)))]
+
+        last = len(self) - 1
+        heap: List[Tuple[float, int]] = []
+        seen = set()
+        for depth in range(len(self)):
+            threshold = 0.0
+            for column, weight in columns:
+                # a positive weight reads the column from its highest value
+                position = self.ascending[column][last - depth if weight > 0 else depth]
+                threshold += weight * self.values[column][position]
+                if position in seen:
+                    continue
+                seen.add(position)
+                item = (self.score(position, weights), -position)
+                if len(heap) < k:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+            # ties with the threshold may still be unread, they win over the heap by the table order
+            if len(heap) == k and heap[0][0] > threshold:
+                break
+        return sorted(heap, reverse=True)
+
+    def for_dates(self, first: Optional[str] = None, last: Optional[str] = None) -> "RankingIndex":
+        """
+        Index of the cities ranked over the days between `first` and `last` only.
+        A range not among the last `max_ranges` ones costs a rebuild: filtering, ranking and sorting the daily rows.
+        """
+        if self.daily is None:
+            raise ValueError("Date range queries need the daily rows")
+        key = (first, last)
+        if key in self._ranges:
+            self._ranges.move_to_end(key)
+            return self._ranges[key]
+        daily = self.daily
+        if first is not None:
+            daily = daily[daily["date"] >= first]
+        if last is not None:
+            daily = daily[daily["date"] <= last]
+        index = RankingIndex(DataAggregationTask.rank_cities(daily.reset_index(drop=True)))
+        self._ranges[key] = index
+        if len(self._ranges) > self.max_ranges:
+            self._ranges.popitem(last=False)
+        return index
@@ -0,0 +1,149 @@
+"""
+Sharded forecast_weather: every worker takes its own hash partition of the cities
+and writes per-city sums, the merge combines any number of them into the final table, e.g.
+
+    python3 sharding.py shard --shard 0 --shards 4 --output partials/0.json
+    python3 sharding.py merge partials/*.json --output weather-stats.csv
+"""
+import argparse
+import hashlib
+import json
+from typing import Dict, Iterable, Optional
+
+import pandas as pd
+
+from external.cache import ResponseCache
+from forecasting import fetch_and_calculate
+from log_progress import logger, setup_logging
+from pipeline import PartialAggregation
+from tasks import DataAggregationTask, DataAnalyzingTask, DataCalculationTask
+from utils import CITIES
+from writers import DEFAULT_RESULTS_PATH, atomic_file, write_results
+
+PARTIAL_VERSION = 1
+
+
+def shard_of(city: str, shards: int) -> int:
+    """Same on every host and run, unlike the salted built-in hash()"""
+    digest = hashlib.blake2b(city.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shards
+
+
+def shard_cities(cities: Dict[str, str], shard: int, shards: int) -> Dict[str, str]:
+    if not 0 <= shard < shards:
+        raise ValueError(f"Shard {shard} is out of range for {shards} shards")
+    return {city: url for city, url in cities.items() if shard_of(city, shards) == shard}
+
+
+def write_partial(totals: Dict[str, dict], path: str, shard: int, shards: int) -> str:
+    """Columns of per-city day counts, sums of daily average temperatures and good hours"""
+    cities = sorted(totals)
+    partial = {
+        "version": PARTIAL_VERSION,
+        "shard": shard,
+        "shards": shards,
+        "city": cities,
+        "days": [totals[city]["days"] for city in cities],
+        "avg_temp_sum": [totals[city]["avg_temp_sum"] for city in cities],
+        "n_hours_good_weather": [totals[city]["n_hours_good_weather"] for city in cities],
+    }
+    with atomic_file(path, "w", encoding="utf-8") as file:
+        file.write(json.dumps(partial))
+    return path
+
+
+def read_partial(path: str) -> dict:
+    with open(path, encoding="utf-8") as file:
+        partial = json.load(file)
+    if partial.get("version") != PARTIAL_VERSION:
+        raise ValueError(f"Unsupported partial result version in {path}: {partial.get('version')}")
+    return partial
+
+
+def run_shard(
+    shard: int,
+    shards: int,
+    output_path: str,
+    cities: Optional[Dict[str, str]] = None,
+    fetch_mode: str = "threads",
+    cache: Optional[ResponseCache] = None,
+    streaming: bool = False,
+    calc_engine: str = "pool",
+) -> str:
+    cities = shard_cities(CITIES if cities is None else cities, shard, shards)
+    # only the per-city sums are written, the table and the ranks are left to merge_partials
+    aggregation = PartialAggregation(keep_rows=False)
+    if cities:
+        aggregation.add(fetch_and_calculate(cities, fetch_mode, cache, streaming, calc_engine))
+    logger.info(f"Shard {shard} of {shards}: {len(aggregation.totals)} of {len(cities)} cities calculated")
+    return write_partial(aggregation.totals, output_path, shard, shards)
+
+
+def merge_partials(paths: Iterable[str]) -> pd.DataFrame:
+    """The ranked per-city table of DataAggregationTask.merge_results from the partials of all shards"""
+    columns = {"city": [], "days": [], "avg_temp_sum": [], "n_hours_good_weather": []}
+    shards = set()
+    for path in paths:
+        partial = read_partial(path)
+        shards.add((partial["shard"], partial["shards"]))
+        for column, values in columns.items():
+            values.extend(partial[column])
+    n_shards = {n_shards for _, n_shards in shards}
+    if len(n_shards) > 1:
+        raise ValueError("Partials of different shard counts can not be merged")
+    missing = set(range(n_shards.pop())) - {shard for shard, _ in shards} if n_shards else set()
+    if missing:
+        logger.warning(f"Merging without shards: {', '.join(map(str, sorted(missing)))}")
+
+    totals = pd.DataFrame(columns)
+    if totals.city.duplicated().any():
+        raise ValueError(f"Cities in more than one partial: {', '.join(totals.city[totals.city.duplicated()])}")
+    totals = totals.sort_values("city", ignore_index=True)
+    merged_results = pd.DataFrame({
+        "city": totals.city,
+        "avg_temp": totals.avg_temp_sum / totals.days,
+        "n_hours_good_weather": totals.n_hours_good_weather.astype("int64"),
+    })
+    return DataAggregationTask.add_ranks(merged_results)
+
+
+def load_cities(path: Optional[str]) -> Dict[str, str]:
+    """Json object of city names and forecast urls, utils.CITIES by default"""
+    if path is None:
+        return CITIES
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    shard = subparsers.add_parser("shard", help="fetch and calculate one hash partition of the cities")
+    shard.add_argument("--shard", type=int, required=True)
+    shard.add_argument("--shards", type=int, required=True)
+    shard.add_argument("--output", required=True, help="partial result file")
+    shard.add_argument("--cities-file", help="json object of city names and urls, utils.CITIES by default")
+    shard.add_argument("--fetch-mode", choices=("threads", "async"), default="threads")
+    shard.add_argument("--calc-engine", choices=DataCalculationTask.ENGINES, default="pool")
+
+    merge = subparsers.add_parser("merge", help="ranked table and best cities from the partial results")
+    merge.add_argument("partials", nargs="+")
+    merge.add_argument("--output", default=DEFAULT_RESULTS_PATH)
+    merge.add_argument("--format", help="csv, ndjson, npz or xlsx, by the extension of --output by default")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    setup_logging()
+    args = parse_args()
+    if args.command == "shard":
+        run_shard(
+            args.shard, args.shards, args.output,
+            cities=load_cities(args.cities_file), fetch_mode=args.fetch_mode, calc_engine=args.calc_engine,
+        )
+    else:
+        df = merge_partials(args.partials)
+        write_results(df, path=args.output, fmt=args.format)
+        best_city = DataAnalyzingTask(df=df).analyze_cities()
+        print(f"Best city(-es): {','.join(best_city)}")
@@ -0,0 +1,217 @@
+import copy
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter, deque
+from email.utils import formatdate
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, List, Optional, Union
+
+EXAMPLE_RESPONSE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples", "response.json")
+STUB_CONDITIONS = (
+    "clear",
+    "partly-cloudy",
+    "cloudy",
+    "overcast",
+    "drizzle",
+    "light-rain",
+    "rain",
+    "showers",
+    "thunderstorm",
+)
+
+
+def load_example_response(path: str = EXAMPLE_RESPONSE_PATH) -> dict:
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def make_city_payload(base: dict, seed: int) -> dict:
+    """Build a forecast shaped like examples/response.json with shifted temperatures and conditions"""
+    rnd = random.Random(seed)
+    payload = copy.deepcopy(base)
+    temp_shift = rnd.randint(-15, 15)
+    for forecast_ in payload.get("forecasts", []):
+        for hourly_data in forecast_.get("hours", []):
+            hourly_data["temp"] += temp_shift + rnd.randint(-2, 2)
+            hourly_data["condition"] = rnd.choice(STUB_CONDITIONS)
+    return payload
+
+
+def make_cities_payloads(n_cities: int, base: Optional[dict] = None) -> Dict[str, bytes]:
+    """Encoded payloads for `n_cities` synthetic cities keyed by city name"""
+    base = base if base is not None else load_example_response()
+    return {
+        f"CITY{i:06d}": json.dumps(make_city_payload(base, seed=i)).encode("utf-8")
+        for i in range(n_cities)
+    }
+
+
+# int - answer with this status, float - wait that many seconds before answering
+Fault = Union[int, float]
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "_StubHTTPServer"
+
+    def do_GET(self):
+        delay = self.server.delays.get(self.path)
+        if delay:
+            time.sleep(delay)
+
+        fault = self.server.next_fault(self.path)
+        if isinstance(fault, int):
+            self.server.count(fault)
+            self.send_error(fault)
+            return
+        if fault:
+            time.sleep(fault)
+
+        body = self.server.routes.get(self.path)
+        if body is None:
+            self.server.count(HTTPStatus.NOT_FOUND)
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            self.server.count(HTTPStatus.NOT_MODIFIED)
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.server.count(HTTPStatus.OK)
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", self.server.last_modified)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(
+        self,
+        address,
+        routes: Dict[str, bytes],
+        delays: Dict[str, float],
+        faults: Dict[str, List[Fault]],
+        failure_rate: float = 0.0,
+        slow_rate: float = 0.0,
+        slow_delay: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        super().__init__(address, _StubHandler)
+        self.routes = routes
+        self.delays = delays
+        self.faults: Dict[str, Deque[Fault]] = {path: deque(path_faults) for path, path_faults in faults.items()}
+        self.failure_rate = failure_rate
+        self.slow_rate = slow_rate
+        self.slow_delay = slow_delay
+        self.random = random.Random(seed)
+        self.last_modified = formatdate(usegmt=True)
+        self.requests: Counter = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, status: HTTPStatus):
+        with self.lock:
+            self.requests[int(status)] += 1
+
+    def next_fault(self, path: str) -> Optional[Fault]:
+        with self.lock:
+            path_faults = self.faults.get(path)
+            if path_faults:
+                return path_faults.popleft()
+            if self.failure_rate and self.random.random() < self.failure_rate:
+                return int(HTTPStatus.SERVICE_UNAVAILABLE)
+            if self.slow_rate and self.random.random() < self.slow_rate:
+                return self.slow_delay
+        return None
+
+    def handle_error(self, request, client_address):
+        # clients drop the requests they stopped waiting for, that is expected here
+        pass
+
+
+class StubWeatherServer:
+    """
+    In-process HTTP server which serves forecast payloads instead of the Yandex storage
+    """
+
+    def __init__(
+        self,
+        payloads: Dict[str, bytes],
+        host: str = "127.0.0.1",
+        port: int = 0,
+        delays: Optional[Dict[str, float]] = None,
+        faults: Optional[Dict[str, List[Fault]]] = None,
+        failure_rate: float = 0.0,
+        slow_rate: float = 0.0,
+        slow_delay: float = 1.0,
+        seed: Optional[int] = None,
+    ):
+        """
+        :param delays: seconds to wait before answering, by city
+        :param faults: by city, one fault for each of the next requests: an int is the status
+            to answer with (e.g. 503), a float is a delay in seconds
+        :param failure_rate: share of the other requests answered with 503
+        :param slow_rate: share of the other requests delayed by `slow_delay` seconds
+        :param seed: makes the random faults repeatable
+        """
+        self.paths = {city: self.path_for(city) for city in payloads}
+        self.routes = {self.paths[city]: body for city, body in payloads.items()}
+        delays = {self.path_for(city): delay for city, delay in (delays or {}).items()}
+        faults = {self.path_for(city): city_faults for city, city_faults in (faults or {}).items()}
+        self.httpd = _StubHTTPServer(
+            (host, port), self.routes, delays, faults,
+            failure_rate=failure_rate, slow_rate=slow_rate, slow_delay=slow_delay, seed=seed,
+        )
+        self.thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def path_for(city: str) -> str:
+        return f"/{city.lower()}-response.json"
+
+    @property
+    def requests(self) -> Counter:
+        """Number of served requests by response status"""
+        return self.httpd.requests
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def cities(self) -> Dict[str, str]:
+        """Mapping city -> url in the same shape as utils.CITIES"""
+        return {city: f"{self.base_url}{path}" for city, path in self.paths.items()}
+
+    def start(self) -> "StubWeatherServer":
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self) -> "StubWeatherServer":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -1,7 +1,20 @@
+import asyncio
 import unittest
-from unittest.mock import patch
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures.process import BrokenProcessPool
+from unittest.mock import Mock, patch
+import io
+import json
 import os
+import subprocess
+import sqlite3
+import sys
+import tempfile
+import threading
+from typing import Iterator, Tuple
 
+import numpy as np
 import pandas as pd
 
 from tasks import (
@@ -9,16 +22,326 @@ from tasks import (
     DataCalculationTask,
     DataAggregationTask,
     DataAnalyzingTask,
+    get_process_pool,
 )
+from external.analyzer import (
+    DEFAULT_OUTPUT_RESULT,
+    DayInfo,
+    analyze_batch,
+    analyze_json,
+    analyze_store,
+    find_input_files,
+)
+from external.cache import ResponseCache
+from external.forecast_store import ForecastStore
+from external.stream_parser import parse_forecasts
+from fetch_policy import FetchPolicy, PolicyRunner
+from forecasting import forecast_weather
+from incremental import IncrementalCalculation
+from metrics import Metrics
+from pipeline import WeatherPipeline
+from quick_forecast import fetch_cities, quick_forecast
+from ranking import RankingIndex
+from sharding import merge_partials, shard_cities, write_partial
+from writers import atomic_file, write_results
+from stub_server import StubWeatherServer, make_cities_payloads
 from utils import CITIES
 
 
+def make_calculation_info(n_cities: int = 20) -> dict:
+    """Decoded payloads with a city without forecasts and a city with broken hours"""
+    info = {city: json.loads(body) for city, body in make_cities_payloads(n_cities).items()}
+    info["NO_FORECASTS"] = {"info": {}}
+    info["BROKEN"] = {"forecasts": [{"date": "2022-05-18", "hours": [{"hour": "9"}] * 24}]}
+    return info
+
+
+@contextmanager
+def stub_cities(n_cities: int, **server_options) -> Iterator[Tuple[StubWeatherServer, dict]]:
+    """A stub server of `n_cities` payloads and its cities, with MISSING answering 404"""
+    with StubWeatherServer(make_cities_payloads(n_cities), **server_options) as server:
+        cities = server.cities()
+        cities["MISSING"] = f"{server.base_url}/missing-response.json"
+        yield server, cities
+
+
+def staged_results(info: dict, cities: list) -> pd.DataFrame:
+    """The per-city table of the staged flow with the pool engine, the reference for the other flows"""
+    calculation_task = DataCalculationTask(info=info)
+    calculation_task.run_concurrent(cities=cities, engine="pool")
+    return DataAggregationTask(data=calculation_task.weather_analytics).merge_results(workers=2)
+
+
+def fetch_staged_results(cities: dict) -> pd.DataFrame:
+    fetching_task = DataFetchingTask()
+    fetching_task.get_cities_weather(cities=cities)
+    return staged_results(fetching_task.weather_info, list(cities))
+
+
+def calc_weather_stats_loop(info: dict, cities: list) -> dict:
+    """weather_analytics of calc_weather_stats city by city, the reference for the engines"""
+    expected = {}
+    for city in cities:
+        expected.update(DataCalculationTask(info=info).calc_weather_stats(city))
+    return expected
+
+
 class TestDataFetchingTask(unittest.TestCase):
     def test_get_cities_weather(self):
         task = DataFetchingTask()
         task.get_cities_weather(cities=CITIES)
         self.assertIsNotNone(task.weather_info)
 
+    def test_get_cities_weather_async_matches_threads(self):
+        with stub_cities(30) as (server, cities):
+
+            threads_task = DataFetchingTask()
+            threads_task.get_cities_weather(cities=cities)
+            async_task = DataFetchingTask(concurrency=4)
+            async_task.get_cities_weather_async(cities=cities)
+
+        self.assertEqual(len(async_task.weather_info), 30)
+        self.assertNotIn("MISSING", async_task.weather_info)
+        self.assertEqual(async_task.weather_info, threads_task.weather_info)
+
+
+class TestFetchPolicy(unittest.TestCase):
+    def fetch(self, policy: FetchPolicy, fetch_mode: str, **server_options) -> DataFetchingTask:
+        with stub_cities(6, **server_options) as (server, cities):
+            task = DataFetchingTask(workers=3, concurrency=3, policy=policy)
+            if fetch_mode == "async":
+                task.get_cities_weather_async(cities=cities)
+            else:
+                task.get_cities_weather(cities=cities)
+            self.requests = server.requests
+        return task
+
+    def test_retries_timeouts_and_hedging(self):
+        faults = {
+            "CITY000000": [503, 503],
+            "CITY000001": [503, 503, 503],
+            "CITY000002": [5.0],
+            "CITY000003": [0.5, 5.0],
+        }
+        policy = FetchPolicy(timeout=0.3, retries=2, backoff=0.01)
+        hedging_policy = FetchPolicy(timeout=3.0, retries=0, hedge=True, hedge_delay=0.1)
+        for fetch_mode in ("threads", "async"):
+            with self.subTest(fetch_mode=fetch_mode):
+                task = self.fetch(policy, fetch_mode, faults=faults)
+                report = task.fetch_report
+                self.assertEqual((report["CITY000000"]["outcome"], report["CITY000000"]["attempts"]), ("ok", 3))
+                self.assertEqual((report["CITY000001"]["outcome"], report["CITY000001"]["attempts"]), ("failed", 3))
+                self.assertEqual((report["CITY000002"]["outcome"], report["CITY000002"]["attempts"]), ("ok", 2))
+                self.assertEqual((report["CITY000003"]["outcome"], report["CITY000003"]["attempts"]), ("ok", 3))
+                self.assertEqual((report["MISSING"]["outcome"], report["MISSING"]["attempts"]), ("failed", 1))
+                self.assertEqual(self.requests[503], 5)
+                self.assertEqual(len(task.weather_info), 5)
+                self.assertEqual(task.metrics.counters["fetch_retries"], 7)
+                # one latency per city, however many attempts it took
+                self.assertEqual(len(task.metrics.histograms["fetch_latency_s"].values), 7)
+
+                task = self.fetch(hedging_policy, fetch_mode, faults={"CITY000002": [2.0]})
+                report = task.fetch_report["CITY000002"]
+                self.assertEqual((report["outcome"], report["attempts"], report["hedges"]), ("ok", 1, 1))
+                # the duplicate request answered, not the delayed first one
+                self.assertEqual(task.metrics.counters["fetch_hedge_wins"], 1)
+
+    def test_run_deadline(self):
+        delays = {f"CITY{i:06d}": 0.4 for i in range(6)}
+        task = self.fetch(FetchPolicy(deadline=0.6), "threads", delays=delays)
+        outcomes = Counter(report["outcome"] for report in task.fetch_report.values())
+        self.assertEqual(outcomes["ok"], len(task.weather_info))
+        self.assertGreater(outcomes["deadline"], 0)
+        self.assertEqual(task.metrics.counters["fetch_deadline_exceeded"], outcomes["deadline"])
+
+    def test_one_attempt_pool_per_run(self):
+        runner = PolicyRunner(FetchPolicy(), Metrics(), workers=8)
+        barrier = threading.Barrier(8)
+
+        def slow_pool(*args, **kwargs):
+            threading.Event().wait(0.05)
+            return Mock()
+
+        def first_attempt():
+            barrier.wait()
+            executors.append(runner.executor)
+
+        executors = []
+        with patch("fetch_policy.concurrent.futures.ThreadPoolExecutor", side_effect=slow_pool) as pool:
+            threads = [threading.Thread(target=first_attempt) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(pool.call_count, 1)
+        self.assertEqual(len({id(executor) for executor in executors}), 1)
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "responses.sqlite3")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_fresh_and_revalidated_responses(self):
+        with StubWeatherServer(make_cities_payloads(10)) as server:
+            cities = server.cities()
+            cache = ResponseCache(path=self.path, ttl=3600)
+
+            cold = DataFetchingTask(cache=cache)
+            cold.get_cities_weather(cities=cities)
+            warm = DataFetchingTask(cache=cache)
+            warm.get_cities_weather(cities=cities)
+            self.assertEqual(server.requests[200], 10)
+
+            cache.ttl = 0
+            revalidated = DataFetchingTask(concurrency=3, cache=cache)
+            revalidated.get_cities_weather_async(cities=cities)
+            self.assertEqual(server.requests[304], 10)
+
+        self.assertEqual(warm.weather_info, cold.weather_info)
+        self.assertEqual(revalidated.weather_info, cold.weather_info)
+        stats = cache.stats()
+        self.assertEqual((stats["misses"], stats["hits"], stats["revalidated"]), (10, 10, 10))
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(path=self.path, max_bytes=300)
+        for i in range(3):
+            cache.store(f"http://stub/{i}", b"x" * 100, {})
+        cache.fetch("http://stub/0", lambda headers: (404, {}, b""))
+        cache.store("http://stub/3", b"x" * 100, {})
+
+        self.assertIsNotNone(cache.lookup("http://stub/0"))
+        self.assertIsNone(cache.lookup("http://stub/1"))
+        self.assertIsNotNone(cache.lookup("http://stub/2"))
+        self.assertIsNotNone(cache.lookup("http://stub/3"))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_async_fetch_does_not_block_event_loop(self):
+        cache = ResponseCache(path=self.path)
+        # another process holding the write lock
+        other = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        other.execute("BEGIN IMMEDIATE")
+        threading.Timer(0.3, other.execute, args=("COMMIT",)).start()
+
+        async def opener(headers):
+            return 200, {}, b"body"
+
+        async def main():
+            fetch = asyncio.ensure_future(cache.afetch("http://stub/0", opener))
+            ticks = 0
+            while not fetch.done():
+                await asyncio.sleep(0.01)
+                ticks += 1
+            return await fetch, ticks
+
+        response, ticks = asyncio.run(main())
+        other.close()
+        self.assertEqual(response, (200, b"body"))
+        # the loop kept running while the store waited for the lock
+        self.assertGreater(ticks, 5)
+
+
+class TestStreamParser(unittest.TestCase):
+    def test_projection_matches_full_json(self):
+        with open(os.path.join("examples", "response.json"), "rb") as file:
+            raw = file.read()
+        full = json.loads(raw)
+        expected = [
+            {
+                "date": day["date"],
+                "hours": [{field: hour[field] for field in ("hour", "temp", "condition")} for hour in day["hours"]],
+            }
+            for day in full["forecasts"]
+        ]
+        # small chunks make values cross the window boundaries
+        for chunk_size in (1, 7, 4096, 64 * 1024):
+            self.assertEqual(parse_forecasts(io.BytesIO(raw), chunk_size), {"forecasts": expected})
+
+        # numbers cut after "." or "e", brackets and escapes inside the strings of the skipped values
+        day = {
+            "date": "2022-05-18",
+            "parts": {"night": {"temp_avg": 12.5, "note": "x\\\"]}{[", "prec_mm": 1.5e-3}},
+            "hours": [{"hour": "9", "temp": 12, "condition": "clear", "prec_mm": 0.25}],
+            "biomet": [{"index": 2.0E+1}, []],
+        }
+        raw = json.dumps({"now": 12.5, "fact": {"temp": -1.5e-3, "icon": "}]\"["}, "forecasts": [day, day]}).encode()
+        projected = {"date": "2022-05-18", "hours": [{"hour": "9", "temp": 12, "condition": "clear"}]}
+        for chunk_size in range(1, 24):
+            self.assertEqual(parse_forecasts(io.BytesIO(raw), chunk_size), {"forecasts": [projected, projected]})
+
+    def test_streaming_fetch_gives_same_stats(self):
+        with StubWeatherServer(make_cities_payloads(5)) as server:
+            cities = server.cities()
+            full_task = DataFetchingTask()
+            full_task.get_cities_weather(cities=cities)
+            streaming_task = DataFetchingTask(streaming=True)
+            streaming_task.get_cities_weather(cities=cities)
+
+        full_stats = DataCalculationTask(info=full_task.weather_info)
+        streaming_stats = DataCalculationTask(info=streaming_task.weather_info)
+        for city in cities:
+            self.assertEqual(streaming_stats.calc_weather_stats(city), full_stats.calc_weather_stats(city))
+
+
+class TestForecastStore(unittest.TestCase):
+    def setUp(self):
+        self.info = make_calculation_info()
+
+    def test_days_saved_and_selected(self):
+        # int16 would truncate it
+        self.info["FLOAT_TEMP"] = {
+            "forecasts": [{"date": "2022-05-18", "hours": [{"hour": "9", "temp": 1.5, "condition": "clear"}]}]
+        }
+        store = ForecastStore.from_info(self.info)
+        self.assertEqual(len(store), 20)
+        self.assertEqual(store.failed, {"BROKEN", "FLOAT_TEMP"})
+        self.assertNotIn("NO_FORECASTS", store)
+        with tempfile.TemporaryDirectory() as tmp:
+            mapped = ForecastStore.open(store.save(os.path.join(tmp, "forecasts.fcst")))
+            for city in store:
+                expected = [
+                    (day["date"], [int(hour["hour"]) for hour in day["hours"]],
+                     [hour["temp"] for hour in day["hours"]], [hour["condition"] for hour in day["hours"]])
+                    for day in self.info[city]["forecasts"]
+                ]
+                self.assertEqual(store.days(city), expected)
+                self.assertEqual(mapped.days(city), expected)
+            self.assertEqual(mapped.failed, store.failed)
+            selected = mapped.select(["CITY000007", "BROKEN", "ABSENT", "CITY000003"])
+            self.assertEqual(selected.cities, ["CITY000007", "CITY000003"])
+            self.assertEqual(selected.failed, {"BROKEN"})
+            self.assertEqual(selected.days("CITY000003"), store.days("CITY000003"))
+
+    def test_engines_match_weather_analytics(self):
+        cities = list(self.info) + ["ABSENT"]
+        expected = calc_weather_stats_loop(self.info, cities)
+
+        store = ForecastStore.from_info(self.info)
+        with tempfile.TemporaryDirectory() as tmp:
+            mapped = ForecastStore.open(store.save(os.path.join(tmp, "forecasts.fcst")))
+            for info in (store, mapped):
+                for engine in ("vectorized", "pool"):
+                    task = DataCalculationTask(info=info)
+                    task.run_concurrent(cities=cities, engine=engine)
+                    self.assertEqual(task.weather_analytics, expected)
+
+    def test_compact_fetch(self):
+        with stub_cities(10) as (server, cities):
+            full_task = DataFetchingTask()
+            full_task.get_cities_weather(cities=cities)
+            compact_task = DataFetchingTask(concurrency=4, compact=True)
+            compact_task.get_cities_weather_async(cities=cities)
+
+        self.assertEqual(compact_task.weather_info, {})
+        self.assertEqual(sorted(compact_task.store), sorted(full_task.weather_info))
+        full_stats = DataCalculationTask(info=full_task.weather_info)
+        compact_stats = DataCalculationTask(info=compact_task.forecasts)
+        for city in cities:
+            self.assertEqual(compact_stats.calc_weather_stats(city), full_stats.calc_weather_stats(city))
+
 
 class TestDataCalculationTask(unittest.TestCase):
     def test_run_concurrent(self):
@@ -26,6 +349,41 @@ class TestDataCalculationTask(unittest.TestCase):
         task.run_concurrent(cities=CITIES.keys())
         self.assertEqual(len(task.weather_analytics), len(CITIES))
 
+    def test_vectorized_engine_matches_weather_analytics(self):
+        info = make_calculation_info()
+        cities = list(info) + ["ABSENT"]
+        expected = calc_weather_stats_loop(info, cities)
+
+        task = DataCalculationTask(info=info)
+        task.run_concurrent(cities=cities, engine="vectorized")
+        self.assertEqual(task.weather_analytics, expected)
+        self.assertEqual(task.weather_analytics["ABSENT"], [])
+        self.assertNotIn("BROKEN", task.weather_analytics)
+
+    def test_pool_engine_matches_weather_analytics(self):
+        info = make_calculation_info()
+        cities = list(info) + ["ABSENT"]
+        expected = calc_weather_stats_loop(info, cities)
+
+        pool = get_process_pool()
+        for chunk_size in (None, 3):
+            task = DataCalculationTask(info=info)
+            task.run_pool(cities, chunk_size=chunk_size)
+            self.assertEqual(task.weather_analytics, expected)
+        self.assertIs(get_process_pool(), pool)
+
+    def test_broken_pool_is_replaced(self):
+        info = make_calculation_info(5)
+        pool = get_process_pool()
+        # a worker dying like under the OOM killer
+        with self.assertRaises(BrokenProcessPool):
+            pool.submit(os._exit, 1).result()
+
+        task = DataCalculationTask(info=info)
+        task.run_concurrent(cities=list(info), engine="pool")
+        self.assertIsNot(get_process_pool(), pool)
+        self.assertEqual(task.weather_analytics, calc_weather_stats_loop(info, list(info)))
+
 
 class TestDataAggregationTask(unittest.TestCase):
     def setUp(self):
@@ -85,6 +443,291 @@ class TestDataAggregationTask(unittest.TestCase):
         results = task.merge_results(workers=2).to_json()
         self.assertEqual(results, mock_df)
 
+    def test_save_results_formats(self):
+        task = DataAggregationTask(data=self.data)
+        df = task.merge_results(workers=2)
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_path = task.save_results(path=os.path.join(tmp, "out", "weather-stats.csv"))
+            pd.testing.assert_frame_equal(pd.read_csv(csv_path), df)
+
+            ndjson_path = task.save_results(path=os.path.join(tmp, "weather-stats.json"), fmt="ndjson")
+            pd.testing.assert_frame_equal(pd.read_json(ndjson_path, lines=True), df)
+
+            npz_path = task.save_results(path=os.path.join(tmp, "weather-stats.npz"))
+            with np.load(npz_path) as arrays:
+                self.assertEqual(arrays["city"].tolist(), df.city.tolist())
+                np.testing.assert_array_equal(arrays["cumulative_rank"], df.cumulative_rank)
+
+            with self.assertRaises(ValueError):
+                write_results(df, os.path.join(tmp, "weather-stats.txt"))
+            self.assertEqual(sorted(os.listdir(tmp)), ["out", "weather-stats.json", "weather-stats.npz"])
+
+
+class TestWeatherPipeline(unittest.TestCase):
+    def test_pipeline_matches_staged_flow(self):
+        with stub_cities(15) as (server, cities):
+            staged_df = fetch_staged_results(cities)
+
+            weather_pipeline = WeatherPipeline(chunk_size=4, queue_size=2, max_chunks_in_flight=1)
+            pipeline_df = weather_pipeline.run(cities=cities)
+
+        pd.testing.assert_frame_equal(pipeline_df, staged_df)
+        self.assertEqual(
+            DataAnalyzingTask(df=pipeline_df).analyze_cities(), DataAnalyzingTask(df=staged_df).analyze_cities()
+        )
+        self.assertEqual(len(weather_pipeline.aggregation.snapshot()), 15)
+        histograms = weather_pipeline.metrics.histograms
+        self.assertEqual(len(histograms["fetch_queue_depth"].values), 16)
+        self.assertEqual(len(histograms["fetched_queue_depth"].values), 15)
+        self.assertLessEqual(max(histograms["fetched_queue_depth"].values), 2)
+
+    def run_with_timeout(self, weather_pipeline: WeatherPipeline, cities: dict):
+        """run() in a thread, so that a hang fails the test instead of blocking it"""
+        outcome = {}
+
+        def target():
+            try:
+                outcome["df"] = weather_pipeline.run(cities=cities)
+            except BaseException as e:
+                outcome["error"] = e
+
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        thread.join(timeout=60)
+        self.assertFalse(thread.is_alive(), "WeatherPipeline.run hangs")
+        return outcome
+
+    def test_stage_errors_are_raised(self):
+        broken_pool = Mock()
+        broken_pool.submit.side_effect = BrokenProcessPool("A child process terminated abruptly")
+        with StubWeatherServer(make_cities_payloads(15)) as server:
+            cities = server.cities()
+            with patch("pipeline.get_process_pool", return_value=broken_pool):
+                outcome = self.run_with_timeout(WeatherPipeline(chunk_size=2, queue_size=2), cities)
+            self.assertIsInstance(outcome.get("error"), BrokenProcessPool)
+
+            weather_pipeline = WeatherPipeline()
+            with patch.object(weather_pipeline.fetching_task, "start_run", side_effect=RuntimeError("no runner")):
+                outcome = self.run_with_timeout(weather_pipeline, cities)
+            self.assertIsInstance(outcome.get("error"), RuntimeError)
+
+
+class TestIncrementalCalculation(unittest.TestCase):
+    def test_only_changed_cities_are_recomputed(self):
+        info = {city: json.loads(body) for city, body in make_cities_payloads(12).items()}
+        with tempfile.TemporaryDirectory() as tmp:
+            state_path = os.path.join(tmp, "state.json")
+
+            first = IncrementalCalculation(state_path=state_path)
+            pd.testing.assert_frame_equal(first.run(info), staged_results(info, list(info)))
+            self.assertEqual((first.recomputed, first.skipped), (12, 0))
+
+            changed_city, removed_city = list(info)[:2]
+            info[changed_city]["forecasts"][0]["hours"][12]["temp"] += 40
+            del info[removed_city]
+
+            second = IncrementalCalculation(state_path=state_path)
+            pd.testing.assert_frame_equal(second.run(info), staged_results(info, list(info)))
+            self.assertEqual((second.recomputed, second.skipped), (1, 10))
+
+
+class TestSharding(unittest.TestCase):
+    def test_shards_merge_into_single_node_result(self):
+        n_shards = 3
+        with stub_cities(40) as (server, cities), tempfile.TemporaryDirectory() as tmp:
+            cities_file = os.path.join(tmp, "cities.json")
+            with open(cities_file, "w") as file:
+                json.dump(cities, file)
+
+            partials = [os.path.join(tmp, f"partial-{shard}.json") for shard in range(n_shards)]
+            shard_processes = [
+                subprocess.Popen([
+                    sys.executable, "sharding.py", "shard", "--shard", str(shard), "--shards", str(n_shards),
+                    "--cities-file", cities_file, "--output", partials[shard], "--calc-engine", "vectorized",
+                ])
+                for shard in range(n_shards)
+            ]
+            for process in shard_processes:
+                self.assertEqual(process.wait(timeout=120), 0)
+            sharded_df = merge_partials(partials)
+            with self.assertRaises(ValueError):
+                merge_partials(partials + partials[:1])
+            single_node_df = fetch_staged_results(cities)
+
+        self.assertEqual(
+            sorted(city for shard in range(n_shards) for city in shard_cities(cities, shard, n_shards)),
+            sorted(cities),
+        )
+        pd.testing.assert_frame_equal(sharded_df, single_node_df)
+        self.assertEqual(
+            DataAnalyzingTask(df=sharded_df).analyze_cities(), DataAnalyzingTask(df=single_node_df).analyze_cities()
+        )
+
+    def test_partial_written_atomically(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = write_partial({}, os.path.join(tmp, "partials", "0.json"), 0, 1)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+            with self.assertRaises(RuntimeError), atomic_file(os.path.join(tmp, "partials", "1.json")):
+                raise RuntimeError("interrupted")
+            self.assertEqual(os.listdir(os.path.join(tmp, "partials")), ["0.json"])
+
+
+class TestRankingIndex(unittest.TestCase):
+    def setUp(self):
+        rnd = np.random.default_rng(7)
+        n_cities, dates = 500, ["2022-05-18", "2022-05-19", "2022-05-20"]
+        # rounded temperatures give plenty of ties
+        self.daily = pd.DataFrame({
+            "city": np.repeat([f"CITY{i:03d}" for i in range(n_cities)], len(dates)),
+            "date": dates * n_cities,
+            "avg_temp": rnd.normal(15, 5, n_cities * len(dates)).round(),
+            "n_hours_good_weather": rnd.integers(0, 12, n_cities * len(dates)),
+        })
+        self.df = DataAggregationTask.rank_cities(self.daily)
+        self.index = RankingIndex(self.df, self.daily)
+
+    @staticmethod
+    def brute_force_top_k(df: pd.DataFrame, k: int, weights: dict) -> list:
+        scores = [
+            (sum(weight * row[column] for column, weight in weights.items()), -i, row["city"])
+            for i, row in enumerate(df.to_dict("records"))
+        ]
+        return [(city, score) for score, _, city in sorted(scores, reverse=True)[:k]]
+
+    def test_best_cities_match_analyze_cities(self):
+        self.assertEqual(self.index.best_cities(), DataAnalyzingTask(df=self.df).analyze_cities())
+        mock_df = pd.read_csv(os.path.join("examples", "TEST.csv"), sep=',')
+        self.assertEqual(RankingIndex(mock_df).best_cities(), DataAnalyzingTask(df=mock_df).analyze_cities())
+
+    def test_top_k_matches_brute_force(self):
+        for weights in (
+            {"cumulative_rank": 1},
+            {"avg_temp": 0.7, "n_hours_good_weather": 1.5},
+            {"avg_temp": -1, "rank_good_hours": 2},
+        ):
+            for k in (1, 10, 600):
+                self.assertEqual(
+                    self.index.top_k(k, weights=weights), self.brute_force_top_k(self.df, k, weights)
+                )
+        top = self.index.top_k(len(self.df), by="cumulative_rank")
+        best = self.index.best_cities()
+        self.assertEqual([city for city, _ in top[:len(best)]], best)
+
+    def test_top_k_of_cities_and_dates(self):
+        cities = list(self.df.city[::7])
+        self.assertEqual(
+            self.index.top_k(5, by="avg_temp", cities=cities),
+            self.brute_force_top_k(self.df[self.df.city.isin(cities)], 5, {"avg_temp": 1}),
+        )
+
+        daily = self.daily[self.daily.date >= "2022-05-19"].reset_index(drop=True)
+        df = DataAggregationTask.rank_cities(daily)
+        self.assertEqual(
+            self.index.top_k(5, dates=("2022-05-19", None)), self.brute_force_top_k(df, 5, {"cumulative_rank": 1})
+        )
+        self.assertEqual(
+            self.index.for_dates("2022-05-19").best_cities(), DataAnalyzingTask(df=df).analyze_cities()
+        )
+        with self.assertRaises(ValueError):
+            self.index.top_k(5, weights={"humidity": 1})
+
+    def test_date_range_indexes_are_bounded(self):
+        index = RankingIndex(self.df, self.daily, max_ranges=2)
+        first = index.for_dates("2022-05-19")
+        index.for_dates("2022-05-20")
+        self.assertIs(index.for_dates("2022-05-19"), first)
+        index.for_dates(last="2022-05-19")
+        self.assertEqual(list(index._ranges), [("2022-05-19", None), (None, "2022-05-19")])
+
+
+class TestAnalyzer(unittest.TestCase):
+    def test_batch_matches_analyze_json(self):
+        payloads = make_cities_payloads(20)
+        with tempfile.TemporaryDirectory() as tmp:
+            for city, body in payloads.items():
+                with open(os.path.join(tmp, f"{city}.json"), "wb") as file:
+                    file.write(body)
+            with open(os.path.join(tmp, "BROKEN.json"), "w") as file:
+                file.write("{")
+            output_path = os.path.join(tmp, "output.ndjson")
+            written = analyze_batch(find_input_files(tmp), output_path, workers=2, chunk_size=3)
+            with open(output_path) as file:
+                lines = {line["city"]: line for line in map(json.loads, file)}
+
+        self.assertEqual(written, 21)
+        self.assertIn("error", lines.pop("BROKEN"))
+        for city, body in payloads.items():
+            data = json.loads(body)
+            expected = {"days": [DayInfo(raw_data=day_data).to_json() for day_data in data["forecasts"]]}
+            self.assertEqual(analyze_json(data), expected)
+            self.assertEqual(lines[city], {"city": city, **expected})
+        self.assertEqual(DEFAULT_OUTPUT_RESULT, {"days": []})
+
+    def test_store_matches_analyze_json(self):
+        info = {city: json.loads(body) for city, body in make_cities_payloads(20).items()}
+        info["BROKEN"] = {"forecasts": [{"date": "2022-05-18", "hours": [{"hour": "9"}] * 24}]}
+        with tempfile.TemporaryDirectory() as tmp:
+            store_path = ForecastStore.from_info(info).save(os.path.join(tmp, "forecasts.fcst"))
+            output_path = os.path.join(tmp, "output.ndjson")
+            written = analyze_store(store_path, output_path, workers=2, chunk_size=3)
+            with open(output_path) as file:
+                lines = {line["city"]: line for line in map(json.loads, file)}
+
+        self.assertEqual(written, 21)
+        self.assertIn("error", lines.pop("BROKEN"))
+        for city, city_data in info.items():
+            if city != "BROKEN":
+                self.assertEqual(lines[city], {"city": city, **analyze_json(city_data)})
+
+
+class TestForecastWeather(unittest.TestCase):
+    def test_metrics_snapshot(self):
+        with stub_cities(10) as (server, cities), tempfile.TemporaryDirectory() as tmp:
+            metrics_path = os.path.join(tmp, "metrics.json")
+            forecast_weather(
+                cities=cities, calc_engine="vectorized",
+                results_path=os.path.join(tmp, "weather-stats.csv"), metrics_path=metrics_path,
+            )
+            with open(metrics_path) as file:
+                snapshot = json.load(file)
+
+        self.assertEqual(list(snapshot["stages"]), ["fetch", "calculation", "aggregation", "save", "analysis"])
+        self.assertEqual(snapshot["counters"], {"fetch_errors": 1})
+        histograms = snapshot["histograms"]
+        self.assertEqual(histograms["fetch_latency_s"]["count"], 11)
+        self.assertEqual(histograms["fetch_attempt_latency_s"]["count"], 11)
+        self.assertEqual(histograms["payload_bytes"]["count"], 10)
+        self.assertLessEqual(histograms["payload_bytes"]["p50"], histograms["payload_bytes"]["p99"])
+        self.assertEqual(histograms["fetch_queue_depth"]["count"], 11)
+
+    def test_unsupported_pipeline_options(self):
+        for options in (
+            {"fetch_mode": "async"},
+            {"calc_engine": "vectorized"},
+            {"incremental_state": "state.json"},
+            {"compact": True},
+        ):
+            with self.assertRaises(ValueError):
+                forecast_weather(pipeline=True, cities={}, **options)
+
+
+class TestQuickForecast(unittest.TestCase):
+    def test_matches_pandas_flow(self):
+        with stub_cities(200) as (server, cities):
+            info = fetch_cities(cities)
+
+            fetching_task = DataFetchingTask(streaming=True)
+            fetching_task.get_cities_weather(cities=cities)
+        self.assertEqual(info, fetching_task.weather_info)
+
+        rows = quick_forecast(info)
+        self.assertEqual(rows, staged_results(fetching_task.weather_info, list(cities)).to_dict("records"))
+
+    def test_no_pandas_at_startup(self):
+        code = "import sys, quick_forecast; print(sorted({'pandas', 'numpy', 'tasks'} & set(sys.modules)))"
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), "[]")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,118 @@
+"""
+Per-city statistics and ranks with the standard library only,
+the same numbers as DataCalculationTask and DataAggregationTask without loading pandas
+"""
+from typing import Dict, Iterable, List, Optional, Tuple
+
+FORECAST_HOURS = tuple(range(9, 20))
+GOOD_CONDITIONS = ("partly-cloud", "clear", "cloudy", "overcast")
+FULL_DAY_HOURS = 24
+
+
+def city_days(city_data: dict, forecast_hours=FORECAST_HOURS) -> Dict[str, List[dict]]:
+    """DataCalculationTask.get_city_temp of one payload: the hours of `forecast_hours` of every full day by date"""
+    result = {}
+    for forecast_ in city_data["forecasts"]:
+        if len(forecast_["hours"]) < FULL_DAY_HOURS:
+            continue
+        result[forecast_["date"]] = [
+            {"condition": hourly_data["condition"], "temp": hourly_data["temp"]}
+            for hourly_data in forecast_["hours"]
+            if int(hourly_data["hour"]) in forecast_hours
+        ]
+    return result
+
+
+def day_good_hours(hours_data: List[dict]) -> int:
+    return sum(1 for hourly_data in hours_data if hourly_data["condition"] in GOOD_CONDITIONS)
+
+
+def day_avg_temp(hours_data: List[dict]) -> float:
+    return sum(hourly_data["temp"] for hourly_data in hours_data) / len(hours_data)
+
+
+def days_stats(days: Dict[str, List[dict]]) -> List[dict]:
+    """
+    Statistics of the days of city_days:
+    [{"date": ..., "weather_data": {"avg_temp": ..., "n_hours_good_weather": ...}}, ...]
+    """
+    return [
+        {
+            "date": date,
+            "weather_data": {"avg_temp": day_avg_temp(hours_data), "n_hours_good_weather": day_good_hours(hours_data)},
+        }
+        for date, hours_data in days.items()
+    ]
+
+
+def city_stats(city_data: dict) -> List[dict]:
+    """DataCalculationTask.calc_weather_stats of one payload"""
+    return days_stats(city_days(city_data))
+
+
+def kahan_add(total: float, compensation: float, value: float) -> Tuple[float, float]:
+    """One step of the compensated summation of pandas groupby sum and mean"""
+    y = value - compensation
+    t = total + y
+    return t, t - total - y
+
+
+def mean(values: Iterable[float]) -> float:
+    """
+    Kahan summation like pandas groupby mean: the ranks compare the means exactly,
+    so they have to be the same to the last bit as in DataAggregationTask
+    """
+    total = compensation = 0.0
+    count = 0
+    for value in values:
+        total, compensation = kahan_add(total, compensation, value)
+        count += 1
+    return total / count
+
+
+def aggregate_cities(weather_analytics: Dict[str, List[dict]]) -> List[dict]:
+    """DataAggregationTask.aggregate_cities: mean daily temperature and total good hours, by city name"""
+    rows = []
+    for city in sorted(weather_analytics):
+        days = weather_analytics[city]
+        if not days:
+            continue
+        rows.append({
+            "city": city,
+            "avg_temp": mean(day["weather_data"]["avg_temp"] for day in days),
+            "n_hours_good_weather": sum(day["weather_data"]["n_hours_good_weather"] for day in days),
+        })
+    return rows
+
+
+def rank(values: list) -> List[int]:
+    """pandas rank(ascending=True).astype(int): ties get the truncated average of their positions"""
+    order = sorted(range(len(values)), key=values.__getitem__)
+    ranks = [0] * len(values)
+    start = 0
+    while start < len(order):
+        end = start
+        while end + 1 < len(order) and values[order[end + 1]] == values[order[start]]:
+            end += 1
+        average = int((start + 1 + end + 1) / 2)
+        for i in range(start, end + 1):
+            ranks[order[i]] = average
+        start = end + 1
+    return ranks
+
+
+def add_ranks(rows: List[dict]) -> List[dict]:
+    """DataAggregationTask.add_ranks over the rows of aggregate_cities"""
+    rank_temp = rank([row["avg_temp"] for row in rows])
+    rank_good_hours = rank([row["n_hours_good_weather"] for row in rows])
+    for row, row_rank_temp, row_rank_good_hours in zip(rows, rank_temp, rank_good_hours):
+        row["rank_temp"] = row_rank_temp
+        row["rank_good_hours"] = row_rank_good_hours
+        row["cumulative_rank"] = row_rank_temp + row_rank_good_hours
+    return rows
+
+
+def best_cities(rows: List[dict]) -> List[str]:
+    """DataAnalyzingTask.analyze_cities"""
+    best_rank: Optional[int] = max((row["cumulative_rank"] for row in rows), default=None)
+    return [row["city"] for row in rows if row["cumulative_rank"] == best_rank]
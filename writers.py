@@ -0,0 +1,130 @@
+import csv
+import io
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import IO, TYPE_CHECKING, Dict, Iterator, Optional, Type, Union
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+DEFAULT_RESULTS_PATH = "weather-stats.csv"
+
+# A DataFrame or its columns as lists, the latter is written without loading pandas except for xlsx
+Table = Union["pd.DataFrame", Dict[str, list]]
+
+
+class ResultWriter:
+    """
+    Writes the per-city results table into an open binary file
+    """
+
+    extension = ""
+
+    def write(self, df: Table, file: IO[bytes]):
+        raise NotImplementedError
+
+    @staticmethod
+    def columns(df: Table) -> Dict[str, list]:
+        """Columns as lists of plain Python values"""
+        if isinstance(df, dict):
+            return df
+        return {column: df[column].tolist() for column in df.columns}
+
+
+class CsvWriter(ResultWriter):
+    extension = "csv"
+
+    def write(self, df: Table, file: IO[bytes]):
+        text = io.TextIOWrapper(file, encoding="utf-8", newline="")
+        writer = csv.writer(text)
+        columns = self.columns(df)
+        writer.writerow(columns.keys())
+        writer.writerows(zip(*columns.values()))
+        text.flush()
+        text.detach()
+
+
+class NdjsonWriter(ResultWriter):
+    extension = "ndjson"
+
+    def write(self, df: Table, file: IO[bytes]):
+        columns = self.columns(df)
+        names = list(columns)
+        for values in zip(*columns.values()):
+            file.write(json.dumps(dict(zip(names, values)), ensure_ascii=False).encode("utf-8"))
+            file.write(b"\n")
+
+
+class NpzWriter(ResultWriter):
+    """Columnar binary format: one typed numpy array per column, readable with np.load"""
+
+    extension = "npz"
+
+    def write(self, df: Table, file: IO[bytes]):
+        import numpy as np
+
+        arrays = {}
+        for column in df:
+            values = np.asarray(df[column])
+            arrays[column] = values.astype(str) if values.dtype == object else values
+        np.savez(file, **arrays)
+
+
+class ExcelWriter(ResultWriter):
+    """The slowest one, needs openpyxl"""
+
+    extension = "xlsx"
+
+    def write(self, df: Table, file: IO[bytes]):
+        import pandas as pd
+
+        if isinstance(df, dict):
+            df = pd.DataFrame(df)
+        with pd.ExcelWriter(file, mode='w') as writer:
+            df.to_excel(writer)
+
+
+WRITERS: Dict[str, Type[ResultWriter]] = {
+    writer.extension: writer for writer in (CsvWriter, NdjsonWriter, NpzWriter, ExcelWriter)
+}
+
+
+def get_writer(path: str, fmt: Optional[str] = None) -> ResultWriter:
+    """The writer for `fmt`, or for the extension of `path` if `fmt` is not given"""
+    fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower()
+    try:
+        return WRITERS[fmt]()
+    except KeyError:
+        raise ValueError(f"Unknown results format: {fmt!r}, expected one of {', '.join(WRITERS)}")
+
+
+@contextmanager
+def atomic_file(path: str, mode: str = "wb", suffix: str = ".tmp", encoding: Optional[str] = None) -> Iterator[IO]:
+    """
+    A temporary file next to `path`, renamed to `path` once the block succeeds and removed if it fails,
+    so readers never see a partial file
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=suffix)
+    try:
+        with os.fdopen(fd, mode, encoding=encoding) as file:
+            yield file
+        # mkstemp creates the file readable by the owner only
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def write_results(df: Table, path: str = DEFAULT_RESULTS_PATH, fmt: Optional[str] = None) -> str:
+    """
+    Writes into a temporary file next to `path` and renames it, so readers never see a partial file
+    """
+    writer = get_writer(path, fmt)
+    with atomic_file(path, suffix=f".{writer.extension}.tmp") as file:
+        writer.write(df, file)
+    return path